@@ -0,0 +1,73 @@
+"""
+Compare the old, regex based reconstruction of json data from consul keys
+with the prefix-slicing trie builder that load_json uses now.
+
+    python benchmarks/bench_load_json.py [number of keys]
+"""
+import json
+import re
+import sys
+import timeit
+
+import consulconf.main as cc
+
+
+def old_build_json(entries, jsonfn):
+    """load_json's original tree reconstruction, kept here for comparison"""
+    _jsondata = (
+        (re.sub('.*?/%s/(.*?)/?$' % jsonfn, r'\1', k), v)
+        for k, v in entries)
+    jsondata = {}
+    for k, v in _jsondata:
+        if not k:
+            continue
+        levels = k.split('/')
+        curdct = jsondata
+        while len(levels) > 1:
+            lastkey = levels.pop(0)
+            curdct = curdct.setdefault(lastkey, {})
+        if any(k.endswith(x) for x in ['_inherit', '_modify']):
+            v = json.loads(v)
+        if v:
+            curdct[levels.pop(0)] = v
+        else:
+            if any(k.endswith(x) for x in ['_inherit', '_modify']):
+                curdct[levels.pop(0)] = []
+            else:
+                curdct[levels.pop(0)] = {}
+    return jsondata
+
+
+def new_build_json(entries, prefix):
+    return cc._build_json(cc._relative_keys(prefix, entries))
+
+
+def make_entries(num_keys, prefix='configs/prod/apps'):
+    """Return sorted (key, value) pairs like a recursive GET of one file,
+    with 100 keys per namespace and an _inherit list in each namespace"""
+    entries = []
+    for n in range(num_keys):
+        ns, i = divmod(n, 100)
+        if i == 0:
+            entries.append((
+                '%s/app%s/_inherit' % (prefix, ns), '["_shared%s"]' % ns))
+        else:
+            entries.append((
+                '%s/app%s/SOME_SETTING_%s' % (prefix, ns, i), 'value%s' % i))
+    return sorted(entries)
+
+
+def main(num_keys):
+    prefix = 'configs/prod/apps'
+    entries = make_entries(num_keys, prefix)
+    assert old_build_json(entries, 'apps') == new_build_json(entries, prefix)
+    for name, func, arg in [('regex', old_build_json, 'apps'),
+                            ('trie', new_build_json, prefix)]:
+        best = min(timeit.repeat(
+            lambda: func(entries, arg), number=1, repeat=5))
+        print("%-6s %s keys: %.3fs  (%.2f us/key)" % (
+            name, num_keys, best, best / num_keys * 1e6))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
@@ -0,0 +1,223 @@
+"""
+Time consulconf's main code paths on a synthetic config tree, against the
+in-memory Consul stand-in in consulconf.testing, and print a json report
+with wall times, consul request counts and peak memory of each case.
+
+    python benchmarks/bench_suite.py --files 50 --namespaces 1000 \
+        --keys 20 --fanout 3 --depth 4 > report.json
+
+Namespaces are spread evenly over the files.  Namespace n is at inheritance
+level n % (depth + 1).  Namespaces above level 0 inherit the whole previous
+namespace, plus one key from each of `fanout - 1` other namespaces on the
+level below, so each namespace inherits through `depth` levels.
+"""
+import gc
+import json
+from os.path import join
+import platform
+import shutil
+import sys
+import tempfile
+import time
+try:
+    import tracemalloc
+except ImportError:  # python 2
+    tracemalloc = None
+
+import argparse_tools as at
+
+import consulconf.main as cc
+from consulconf import configure_logging, transport
+from consulconf.testing import FakeConsul
+
+PUTURL = 'http://bench/v1/kv/conf'
+
+
+def make_tree(dirpath, files, namespaces, keys, fanout, depth):
+    """Write a synthetic tree of json files to `dirpath`.
+    Return the list of file names"""
+    per_file = max(1, -(-namespaces // files))  # ceil
+
+    def keypath(n, m, key=None):
+        """The keypath that namespace n uses to point to namespace m"""
+        path = 'ns%s' % m
+        if m // per_file != n // per_file:
+            path = 'f%s.%s' % (m // per_file, path)
+        return path if key is None else '%s.%s' % (path, key)
+
+    tree = {}
+    for n in range(namespaces):
+        data = {'K%s_%s' % (n, k): 'value %s %s' % (n, k)
+                for k in range(keys)}
+        if n % (depth + 1):
+            picks = [n - 1 - (depth + 1) * j for j in range(1, fanout)]
+            data['_inherit'] = [keypath(n, n - 1)] + [
+                keypath(n, m, 'K%s_0' % m) for m in picks if m >= 0]
+        tree.setdefault('f%s' % (n // per_file), {})['ns%s' % n] = data
+    for jsonfn, jsondata in tree.items():
+        with open(join(dirpath, '%s.json' % jsonfn), 'w') as fout:
+            json.dump(jsondata, fout)
+    return sorted(tree)
+
+
+class _Discard(object):
+    def write(self, data):
+        pass
+
+    def flush(self):
+        pass
+
+
+def run_main(*args):
+    """Run consulconf's main() with these command-line args, quietly"""
+    stdout, sys.stdout = sys.stdout, _Discard()
+    try:
+        cc.main(cc.build_arg_parser().parse_args(list(args)))
+    finally:
+        sys.stdout = stdout
+        cc.clear_cache()
+
+
+def _measure(func, repeat):
+    """Return (best wall time, requests sent by the best run, peak MB)"""
+    timings = []
+    for _ in range(repeat):
+        consul = FakeConsul()
+        transport.configure(adapter=consul)
+        run = func(consul)
+        cc.clear_cache()
+        gc.collect()
+        start = time.time()
+        run()
+        timings.append((time.time() - start, len(consul.requests)))
+    peak = None
+    if tracemalloc is not None:
+        consul = FakeConsul()
+        transport.configure(adapter=consul)
+        run = func(consul)
+        cc.clear_cache()
+        gc.collect()
+        tracemalloc.start()
+        try:
+            run()
+            peak = tracemalloc.get_traced_memory()[1] / 1e6
+        finally:
+            tracemalloc.stop()
+    seconds, requests = min(timings)
+    return seconds, requests, peak
+
+
+def cases(basepath, files, concurrency):
+    """Return a list of (name, func), where func(consul) prepares the fake
+    consul and returns the function to time"""
+    def parse_files(consul):
+        return lambda: cc.parse_all(files, basepath)
+
+    def parse_raw(consul):
+        def _run():
+            for jsonfn in files:
+                cc.parse_raw(jsonfn, basepath)
+        return _run
+
+    def copy_raw(consul):
+        return lambda: cc.copy_raw(files, basepath, PUTURL, txn=True)
+
+    def push(**kwargs):
+        def _case(consul):
+            kvs = cc.parse_all(files, basepath)
+            return lambda: cc.put_to_consul(kvs, '%s/' % PUTURL, **kwargs)
+        return _case
+
+    def delete_directories(consul):
+        kvs = cc.parse_all(files, basepath)
+        cc.put_to_consul(kvs, '%s/' % PUTURL, txn=True)
+        del consul.requests[:]
+        return lambda: cc.delete_directories(
+            kvs.keys(), [], '%s/' % PUTURL, concurrency=concurrency)
+
+    def main_files(consul):
+        return lambda: run_main(
+            '-i', basepath, '-p', PUTURL, '--txn', '--daemon', '')
+
+    def main_consul(consul):
+        run_main('-i', basepath, '-p', PUTURL, '--raw', '--txn',
+                 '--daemon', '')
+        del consul.requests[:]
+        return lambda: run_main(
+            '-i', PUTURL, '--dry_run', '--daemon', '')
+
+    return [
+        ('parse', parse_files),
+        ('parse_raw', parse_raw),
+        ('copy_raw txn', copy_raw),
+        ('put_to_consul', push()),
+        ('put_to_consul concurrency=%s' % concurrency,
+         push(concurrency=concurrency)),
+        ('put_to_consul txn', push(txn=True)),
+        ('delete_directories', delete_directories),
+        ('main files -> consul', main_files),
+        ('main consul -> dry_run', main_consul),
+    ]
+
+
+def main(ns):
+    configure_logging(False)
+    dirpath = tempfile.mkdtemp()
+    # keep anything the cases print out of the json report
+    stdout, sys.stdout = sys.stdout, _Discard()
+    try:
+        files = make_tree(
+            dirpath, ns.files, ns.namespaces, ns.keys, ns.fanout, ns.depth)
+        results = []
+        for name, func in cases(dirpath, files, ns.concurrency):
+            if ns.only and not any(x in name for x in ns.only):
+                continue
+            seconds, requests, peak = _measure(func, ns.repeat)
+            sys.stderr.write("%-32s %8.3fs %7s requests  %s MB peak\n" % (
+                name, seconds, requests,
+                '?' if peak is None else '%.1f' % peak))
+            results.append(dict(
+                name=name, seconds=seconds, requests=requests,
+                peak_mb=peak))
+    finally:
+        sys.stdout = stdout
+        transport.reset()
+        shutil.rmtree(dirpath)
+    report = dict(
+        params=dict(files=ns.files, namespaces=ns.namespaces, keys=ns.keys,
+                    fanout=ns.fanout, depth=ns.depth, repeat=ns.repeat,
+                    concurrency=ns.concurrency),
+        python=platform.python_version(), time=time.time(),
+        results=results)
+    out = json.dumps(report, indent=4, sort_keys=True)
+    if ns.output:
+        with open(ns.output, 'w') as fout:
+            fout.write(out)
+    else:
+        print(out)
+
+
+build_arg_parser = at.build_arg_parser([
+    at.add_argument('--files', type=int, default=20, help=(
+        "Number of json files")),
+    at.add_argument('--namespaces', type=int, default=200, help=(
+        "Number of namespaces, spread evenly over the files")),
+    at.add_argument('--keys', type=int, default=10, help=(
+        "Number of keys each namespace defines itself")),
+    at.add_argument('--fanout', type=int, default=3, help=(
+        "Number of _inherit keypaths per inheriting namespace")),
+    at.add_argument('--depth', type=int, default=3, help=(
+        "Number of levels of inheritance")),
+    at.add_argument('--repeat', type=int, default=3, help=(
+        "Time each case this many times and report the fastest run")),
+    at.add_argument('--concurrency', type=int, default=8, help=(
+        "Concurrency of the concurrent push and delete cases")),
+    at.add_argument('--only', nargs='+', help=(
+        "Only run the cases whose names contain one of these strings")),
+    at.add_argument('--output', help=(
+        "Write the json report to this file instead of stdout")),
+], description="Benchmark consulconf on a synthetic config tree")
+
+
+if __name__ == '__main__':
+    main(build_arg_parser().parse_args())
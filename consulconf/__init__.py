@@ -1,13 +1,73 @@
-import os.path as _p
-import pkg_resources as _pkg_resources
 import logging
-__version__ = _pkg_resources.get_distribution(
-    _p.basename(_p.dirname(_p.abspath(__file__)))).version
+import sys
+
+
+def _get_version():
+    """Look up the installed version.  Importing importlib.metadata (or
+    pkg_resources) is slow, so this only runs when __version__ is used, and
+    `python -m consulconf.artifact` never pays for it"""
+    import os.path as _p
+    try:
+        from importlib.metadata import version
+    except ImportError:  # python < 3.8
+        import pkg_resources
+
+        def version(name):
+            return pkg_resources.get_distribution(name).version
+    return version(_p.basename(_p.dirname(_p.abspath(__file__))))
+
+
+if sys.version_info >= (3, 7):
+    def __getattr__(name):
+        if name == '__version__':
+            return _get_version()
+        raise AttributeError(
+            "module %r has no attribute %r" % (__name__, name))
+else:  # modules cannot compute attributes lazily
+    __version__ = _get_version()
 
 log = logging.getLogger('consulconf')
 
 
-def configure_logging(add_handler):
+# attributes that every LogRecord has.  Any other attribute came from extra=
+_RESERVED_LOG_KEYS = frozenset(
+    list(logging.makeLogRecord({}).__dict__) + ['message', 'asctime'])
+
+
+def _log_extras(record):
+    return [(k, v) for k, v in record.__dict__.items()
+            if k not in _RESERVED_LOG_KEYS]
+
+
+class KeyValueFormatter(logging.Formatter):
+    """Append the key:value data passed as extra= to the message.
+        ie log.info('msg', extra=dict(a=1))
+        generates  'msg    a=1'
+    The record itself is left unchanged"""
+    def format(self, record):
+        extras = _log_extras(record)
+        if extras:
+            record = logging.makeLogRecord(record.__dict__)
+            record.msg = "%s    %s" % (record.msg, ' '.join(
+                "%s=%s" % kv for kv in extras))
+        return super(KeyValueFormatter, self).format(record)
+
+
+class JsonLinesFormatter(logging.Formatter):
+    """Format each record as one json object per line, with the key:value
+    data passed as extra= as fields of the object"""
+    def format(self, record):
+        import json  # only needed by --log_json
+        data = dict(_log_extras(record))
+        data.update(
+            time=record.created, level=record.levelname,
+            msg=record.getMessage())
+        if record.exc_info:
+            data['exc_info'] = self.formatException(record.exc_info)
+        return json.dumps(data, default=str, sort_keys=True)
+
+
+def configure_logging(add_handler, json_lines=False):
     """
     Configure log records.  If adding a handler, make the formatter print all
     passed in key:value data.
@@ -18,31 +78,24 @@ def configure_logging(add_handler):
         if True, add a logging.StreamHandler() instance
         if False, do not add any handlers.
         if given a handler instance, add that the the logger
-    """
-    _ignore_log_keys = set(logging.makeLogRecord({}).__dict__)
-
-    def _json_format(record):
-        extras = ' '.join(
-            "%s=%s" % (k, record.__dict__[k])
-            for k in set(record.__dict__).difference(_ignore_log_keys))
-        if extras:
-            record.msg = "%s    %s" % (record.msg, extras)
-        return record
-
-    class JsonFormatter(logging.Formatter):
-        def format(self, record):
-            record = _json_format(record)
-            return super(JsonFormatter, self).format(record)
+    `json_lines` if True, the StreamHandler prints one json object per line
 
+    The logger's level follows its handlers, so that when nothing would be
+    printed, log.debug(...) and friends return immediately.  Code on hot
+    paths should check log.isEnabledFor(...) before building extra= data.
+    """
     if not log.handlers:
         if add_handler is True:
             _h = logging.StreamHandler()
-            _h.setFormatter(JsonFormatter())
+            _h.setFormatter(
+                JsonLinesFormatter() if json_lines else KeyValueFormatter())
             log.addHandler(_h)
         elif isinstance(add_handler, logging.Handler):
             log.addHandler(add_handler)
         else:
             log.addHandler(logging.NullHandler())
-    log.setLevel(logging.DEBUG)
+    levels = [h.level or logging.DEBUG for h in log.handlers
+              if not isinstance(h, logging.NullHandler)]
+    log.setLevel(min(levels) if levels else logging.CRITICAL + 1)
     log.propagate = False
     return log
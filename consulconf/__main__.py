@@ -1,10 +1,22 @@
 """
 Convert a directory into an executable
 """
-from consulconf.main import build_arg_parser, main
+import sys
+
+from consulconf.main import (
+    build_arg_parser, build_compile_arg_parser, build_serve_arg_parser,
+    compile_main, main, serve_main)
 
 
 def go():
+    if sys.argv[1:2] == ['serve']:
+        NS = build_serve_arg_parser().parse_args(sys.argv[2:])
+        serve_main(NS)
+        return
+    if sys.argv[1:2] == ['compile']:
+        NS = build_compile_arg_parser().parse_args(sys.argv[2:])
+        compile_main(NS)
+        return
     NS = build_arg_parser().parse_args()
     main(NS)
 
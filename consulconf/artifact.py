@@ -0,0 +1,173 @@
+"""
+Read and write precompiled app environments (see `consulconf compile`).
+
+An artifact is the resolved key:value data of an app, stored as a sorted
+binary file that is memory-mapped on load.  Building a process environment
+from it needs no consul, no json parsing and no `requests`, so an app can
+start with only this module and the consulconf package (which imports
+`logging`) loaded:
+
+    python -m consulconf.artifact ./artifacts/myapp.kv ./myapp --port 80
+
+File layout (little-endian):
+    magic       8 bytes, MAGIC
+    count       uint32, number of entries
+    index       count * (key offset, key length, value offset, value length)
+                as uint32, sorted by key
+    data        utf-8 encoded keys and values
+"""
+import mmap
+import os
+import struct
+import sys
+
+MAGIC = b'CCKV\x00\x00\x00\x01'
+SUFFIX = '.kv'
+_HEADER = struct.Struct('<8sI')
+_ENTRY = struct.Struct('<IIII')
+
+
+def artifact_name(app):
+    """The file name (without suffix) of an app's artifacts.  `app` is a
+    namespace name, or namespaces combined with +"""
+    return app.replace('%', '%25').replace('/', '%2F')
+
+
+def artifact_path(dirpath, app):
+    return os.path.join(dirpath, artifact_name(app) + SUFFIX)
+
+
+def _encode(text):
+    return text if isinstance(text, bytes) else text.encode('utf-8')
+
+
+def _decode(data):
+    return data if str is bytes else data.decode('utf-8')
+
+
+def dumps(env):
+    """Return the artifact of dict `env` as bytes"""
+    items = sorted((_encode(k), _encode(v)) for k, v in env.items())
+    offset = _HEADER.size + _ENTRY.size * len(items)
+    index = []
+    data = []
+    for k, v in items:
+        index.append(_ENTRY.pack(offset, len(k), offset + len(k), len(v)))
+        data.extend((k, v))
+        offset += len(k) + len(v)
+    return b''.join([_HEADER.pack(MAGIC, len(items))] + index + data)
+
+
+def write(fp, env):
+    """Atomically write the artifact of dict `env` to file path `fp`"""
+    tmpfp = '%s.tmp%s' % (fp, os.getpid())
+    try:
+        with open(tmpfp, 'wb') as fout:
+            fout.write(dumps(env))
+        os.rename(tmpfp, fp)
+    except BaseException:
+        if os.path.exists(tmpfp):
+            os.remove(tmpfp)
+        raise
+
+
+class Artifact(object):
+    """A memory-mapped artifact.  Behaves like a read-only dict whose keys
+    are looked up by binary search, without reading the whole file"""
+    def __init__(self, fp):
+        with open(fp, 'rb') as fin:
+            self._map = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self._count = _HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC:
+            self._map.close()
+            raise ValueError("Not a consulconf artifact: %s" % fp)
+
+    def _entry(self, i):
+        return _ENTRY.unpack_from(self._map, _HEADER.size + _ENTRY.size * i)
+
+    def _key(self, i):
+        koff, klen, _, _ = self._entry(i)
+        return self._map[koff:koff + klen]
+
+    def _value(self, i):
+        _, _, voff, vlen = self._entry(i)
+        return _decode(self._map[voff:voff + vlen])
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, key):
+        key = _encode(key)
+        lo, hi = 0, self._count
+        while lo < hi:  # bisect over the sorted index
+            mid = (lo + hi) // 2
+            if self._key(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self._count and self._key(lo) == key:
+            return self._value(lo)
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        return [_decode(self._key(i)) for i in range(self._count)]
+
+    def items(self):
+        return [(_decode(self._key(i)), self._value(i))
+                for i in range(self._count)]
+
+    def close(self):
+        self._map.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def load(fp):
+    """Return the key:value data of an artifact as a dict"""
+    with Artifact(fp) as artifact:
+        return dict(artifact.items())
+
+
+def environ(fp, inherit_env=False):
+    """Return the process environment of an artifact.  If `inherit_env`,
+    start from the current environment"""
+    env = dict(os.environ) if inherit_env else {}
+    env.update(load(fp))
+    return env
+
+
+def exec_app(fp, argv, inherit_env=False):
+    """Replace this process with command `argv`, run in the environment of
+    the artifact at file path `fp`"""
+    os.execvpe(argv[0], argv, environ(fp, inherit_env))
+
+
+def main(argv=None):
+    """python -m consulconf.artifact [--inherit_env] ARTIFACT CMD [ARGS...]
+    """
+    args = list(sys.argv[1:] if argv is None else argv)
+    inherit_env = args[:1] == ['--inherit_env']
+    if inherit_env:
+        args.pop(0)
+    if len(args) < 2:
+        sys.stderr.write("usage: %s\n" % main.__doc__.strip())
+        sys.exit(2)
+    try:
+        exec_app(args[0], args[1:], inherit_env)
+    except (IOError, OSError, ValueError) as err:
+        sys.stderr.write("consulconf: %s\n" % err)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
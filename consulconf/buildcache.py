@@ -0,0 +1,95 @@
+"""
+A persisted build cache for directories of json files, so that a rerun only
+re-parses the files that changed and the files that inherit from them.
+
+The cache records, for each file, a hash of its contents, the other files its
+_inherit keypaths point to, and the namespaces it resolved to.
+"""
+import hashlib
+import json
+from os.path import join
+
+from consulconf import log, util
+
+VERSION = 1
+
+
+def file_hash(basepath, jsonfn):
+    with open(join(basepath, '%s.json' % jsonfn), 'rb') as fin:
+        return hashlib.sha1(fin.read()).hexdigest()
+
+
+def load(cache_fp, basepath):
+    """Return the cached {jsonfn: {"hash", "deps", "namespaces"}} or {}"""
+    try:
+        with open(cache_fp) as fin:
+            cache = json.load(fin)
+    except (IOError, OSError, ValueError):
+        return {}
+    if cache.get('version') != VERSION or cache.get('basepath') != basepath:
+        log.info("Ignoring build cache made for another input",
+                 extra=dict(cache_fp=cache_fp))
+        return {}
+    return cache['files']
+
+
+def save(cache_fp, basepath, files):
+    util.atomic_write_json(
+        cache_fp, dict(version=VERSION, basepath=basepath, files=files))
+
+
+def stale_files(cached, hashes):
+    """Return the set of files that must be rebuilt:  files that are new or
+    changed, and files that (transitively) inherit from files that changed
+    or were removed.
+
+    `cached` the files recorded in the build cache
+    `hashes` {jsonfn: hash} of the current files
+    """
+    changed = set(
+        jsonfn for jsonfn, h in hashes.items()
+        if jsonfn not in cached or cached[jsonfn]['hash'] != h)
+    changed.update(set(cached).difference(hashes))
+    dependents = {}
+    for jsonfn, entry in cached.items():
+        for dep in entry['deps']:
+            dependents.setdefault(dep, set()).add(jsonfn)
+    stale = set()
+    todo = list(changed)
+    while todo:
+        jsonfn = todo.pop()
+        if jsonfn in stale:
+            continue
+        stale.add(jsonfn)
+        todo.extend(dependents.get(jsonfn, ()))
+    return stale.intersection(hashes)
+
+
+def build(files, basepath, cache_fp, parse, dependencies, validate):
+    """Resolve the namespaces of all files, reusing the cached namespaces of
+    files that did not change.  Return (kvs, list of rebuilt files)
+
+    `parse(jsonfn)` return the (namespace, key:value data) pairs of a file
+    `dependencies(jsonfn)` return the other files a file inherits from
+    `validate(files)` check the _inherit keypaths of the given files
+    """
+    cached = load(cache_fp, basepath)
+    hashes = {jsonfn: file_hash(basepath, jsonfn) for jsonfn in files}
+    rebuilt = sorted(stale_files(cached, hashes))
+    log.info("Rebuilding files", extra=dict(
+        rebuilt=rebuilt, reused=len(files) - len(rebuilt)))
+
+    validate(rebuilt)
+    entries = {jsonfn: cached[jsonfn] for jsonfn in files
+               if jsonfn not in rebuilt}
+    for jsonfn in rebuilt:
+        entries[jsonfn] = dict(
+            hash=hashes[jsonfn], deps=sorted(dependencies(jsonfn)),
+            namespaces=dict(parse(jsonfn)))
+    if rebuilt or set(entries) != set(cached):
+        save(cache_fp, basepath, entries)
+
+    kvs = {}
+    for jsonfn in files:
+        kvs.update(entries[jsonfn]['namespaces'])
+    return kvs, rebuilt
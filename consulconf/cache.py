@@ -0,0 +1,144 @@
+"""
+A bounded cache for the json data that load_json reads from files or consul
+"""
+from collections import OrderedDict
+from contextlib import contextmanager
+import threading
+import time
+
+
+class TreeCache(object):
+    """A thread safe LRU cache of json data, keyed by (jsonfn, basepath).
+
+    `maxsize` max number of entries to keep.  None for no limit
+    `ttl` seconds an entry stays valid.  None to keep entries until they are
+        invalidated or evicted
+    `negative_ttl` seconds to remember that a file does not exist.  None to
+        use `ttl`
+
+    `generation` increases whenever data is cached for a file whose data
+    was cached before with another version, so data derived from cached
+    entries knows when to recompute itself.  Evicting, expiring or
+    invalidating an entry does not change it: data that is reloaded
+    unchanged keeps what was derived from it valid
+    """
+    def __init__(self, maxsize=1024, ttl=None, negative_ttl=None):
+        self._entries = OrderedDict()  # key: (expires, value, index, error)
+        self._lock = threading.Lock()
+        self._versions = {}  # key: version of the data last cached
+        self._pins = 0
+        self.generation = 0
+        self.hits = self.misses = self.negative_hits = 0
+        self.evictions = self.expirations = 0
+        self.configure(maxsize=maxsize, ttl=ttl, negative_ttl=negative_ttl)
+
+    def configure(self, maxsize=None, ttl=None, negative_ttl=None):
+        """Change the bounds of the cache.  See the class docstring"""
+        with self._lock:
+            self.maxsize = maxsize
+            self.ttl = ttl
+            self.negative_ttl = ttl if negative_ttl is None else negative_ttl
+            self._evict()
+
+    def stats(self):
+        """Return a dict of hit, miss and eviction counts since creation"""
+        with self._lock:
+            return dict(
+                hits=self.hits, misses=self.misses,
+                negative_hits=self.negative_hits, evictions=self.evictions,
+                expirations=self.expirations, size=len(self._entries),
+                maxsize=self.maxsize)
+
+    @contextmanager
+    def pinned(self):
+        """Neither evict nor expire entries until the block exits, so that
+        data read more than once in the block is only loaded once"""
+        with self._lock:
+            self._pins += 1
+        try:
+            yield self
+        finally:
+            with self._lock:
+                self._pins -= 1
+                self._evict()
+
+    def get(self, jsonfn, basepath):
+        """Return the cached json data.  If the file is known not to exist,
+        raise the error it failed with.  Raise KeyError if not cached"""
+        key = (jsonfn, basepath)
+        with self._lock:
+            try:
+                expires, value, _, error = self._entries[key]
+            except KeyError:
+                self.misses += 1
+                raise
+            if expires is not None and not self._pins \
+                    and time.time() > expires:
+                del self._entries[key]
+                self.expirations += 1
+                self.misses += 1
+                raise KeyError(key)
+            self._entries[key] = self._entries.pop(key)  # most recently used
+            if error is not None:
+                self.negative_hits += 1
+                raise error
+            self.hits += 1
+            return value
+
+    def put(self, jsonfn, basepath, value, index=None, version=None):
+        """Cache json data.  `index` is consul's ModifyIndex for the data.
+        `version` is anything that changes when the data changes, such as a
+        file's modification time.  It defaults to `index`.  If neither is
+        given, the data counts as changed"""
+        self._put(jsonfn, basepath, self.ttl, value, index, None,
+                  index if version is None else version)
+
+    def put_missing(self, jsonfn, basepath, error):
+        """Remember that a file does not exist, and the error it raised"""
+        self._put(jsonfn, basepath, self.negative_ttl, None, None, error,
+                  _MISSING)
+
+    def _put(self, jsonfn, basepath, ttl, value, index, error, version):
+        key = (jsonfn, basepath)
+        expires = None if ttl is None else time.time() + ttl
+        with self._lock:
+            if key in self._versions and (
+                    version is None or self._versions[key] != version):
+                self.generation += 1
+            self._versions[key] = version
+            self._entries.pop(key, None)
+            self._entries[key] = (expires, value, index, error)
+            self._evict()
+
+    def _evict(self):
+        while not self._pins and self.maxsize is not None \
+                and len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, jsonfn=None, basepath=None, older_than=None):
+        """Remove the entries for a file, for everything under a basepath,
+        or both.  If `older_than` is a consul index, only remove entries
+        whose ModifyIndex is smaller.  Return the number of entries removed
+        """
+        with self._lock:
+            keys = [
+                key for key, (_, _, index, _) in self._entries.items()
+                if (jsonfn is None or key[0] == jsonfn)
+                and (basepath is None or key[1] == basepath)
+                and (older_than is None or index is None
+                     or index < older_than)]
+            for key in keys:
+                del self._entries[key]
+            return len(keys)
+
+    def clear(self):
+        """Remove all entries and forget their versions.  Statistics are
+        kept"""
+        with self._lock:
+            self._entries.clear()
+            self._versions.clear()
+            self.generation += 1
+
+
+_MISSING = object()  # the version of a file that does not exist
@@ -0,0 +1,134 @@
+"""
+Work out the fewest consul deletes that clean the namespaces consulconf is
+about to push (ie. --delete), without touching keys matched by
+--delete_excludes, however deep those keys are.
+
+Paths are relative to the --puturl.  A "tree" is deleted recursively as
+"path/", which removes every key inside the directory but not keys that
+merely start with the same characters (deleting tree "app" leaves "app2").
+"""
+import bisect
+from collections import namedtuple
+
+# `trees` directories to delete recursively.  `keys` single keys to delete.
+# `kept` number of existing keys that are kept because they are excluded
+DeletePlan = namedtuple('DeletePlan', ['trees', 'keys', 'kept'])
+
+
+def _trie(paths):
+    """Build a prefix trie of /-separated paths.  A node is a dict of
+    {path component: child node}.  The None key marks the end of a path"""
+    root = {}
+    for path in paths:
+        node = root
+        for part in path.split('/'):
+            node = node.setdefault(part, {})
+        node[None] = True
+    return root
+
+
+def _walk(node, path=None):
+    """Yield (path, node) for each node of the trie, parents first"""
+    stack = [(path, node)]
+    while stack:
+        path, node = stack.pop()
+        yield path, node
+        for part in sorted((p for p in node if p is not None), reverse=True):
+            stack.append((part if path is None else '%s/%s' % (path, part),
+                          node[part]))
+
+
+def targets(keys):
+    """Return the directories (sorted) that --delete cleans for the given
+    namespace names or keys:  the parent directory of each key, or the key
+    itself if it has no parent.  Directories inside another one are left
+    out, since deleting the outer directory removes them"""
+    rv = []
+    stack = [(None, _trie(key.rsplit('/', 1)[0] for key in keys))]
+    while stack:
+        path, node = stack.pop()
+        if None in node:
+            rv.append(path)
+            continue
+        for part, child in node.items():
+            stack.append((part if path is None else '%s/%s' % (path, part),
+                          child))
+    return sorted(rv)
+
+
+class Excludes(object):
+    """Answer prefix questions about --delete_excludes in O(log n)"""
+    def __init__(self, prefixes):
+        self.prefixes = tuple(prefixes)
+        self._sorted = sorted(prefixes)
+
+    def excludes(self, path):
+        """Does an exclude prefix match this path?"""
+        return path.startswith(self.prefixes) if self.prefixes else False
+
+    def inside(self, path):
+        """Does an exclude prefix point somewhere inside directory `path`?"""
+        prefix = '%s/' % path
+        i = bisect.bisect_left(self._sorted, prefix)
+        return i < len(self._sorted) and self._sorted[i].startswith(prefix)
+
+
+def _cover(node, path, excludes):
+    """Return (trees, keys, kept) that delete every key under `node` except
+    excluded ones, using as few deletes as possible"""
+    # post-order walk:  a directory with nothing excluded inside it is
+    # deleted as one tree instead of deleting its children
+    results = {}
+    order = list(_walk(node, path))
+    for p, n in reversed(order):
+        trees, keys, kept, clean = [], [], 0, True
+        if None in n:  # p is itself a key
+            if excludes.excludes(p):
+                kept += 1
+                clean = False
+            else:
+                keys.append(p)
+        for part in n:
+            if part is None:
+                continue
+            ctrees, ckeys, ckept, cclean = results.pop('%s/%s' % (p, part))
+            trees.extend(ctrees)
+            keys.extend(ckeys)
+            kept += ckept
+            clean = clean and cclean
+        if clean and len(n) > (None in n):
+            trees = ['%s/' % p]
+            keys = [p] if None in n else []
+        results[p] = (trees, keys, kept, clean)
+    trees, keys, kept, _ = results[path]
+    return trees, keys, kept
+
+
+def plan(keys, delete_excludes, list_existing):
+    """Return the DeletePlan that cleans the directories of `keys`.
+
+    `delete_excludes` prefixes of paths that must not be deleted
+    `list_existing(path)` return the existing keys under directory `path`.
+        Only called for directories that have excluded paths inside them
+    """
+    excludes = Excludes(delete_excludes)
+    trees, single, kept = [], [], 0
+    for target in targets(keys):
+        if excludes.excludes(target):
+            continue
+        if not excludes.inside(target):
+            trees.append('%s/' % target)
+            if '/' not in target:  # a top level key, or a directory
+                single.append(target)
+            continue
+        existing = _trie(list_existing(target))
+        node = existing
+        for part in target.split('/'):
+            node = node.get(part, {})
+        if not node:
+            continue
+        t, k, n = _cover(node, target, excludes)
+        trees.extend(t)
+        single.extend(k)
+        kept += n
+    return DeletePlan(trees, single, kept)
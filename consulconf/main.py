@@ -5,18 +5,26 @@ This script generates application key:value configuration
 from future.builtins import str
 import argparse_tools as at
 import base64
-from collections import Counter
+import errno
+from collections import Counter, namedtuple
 import glob
 import json
-from os.path import basename, join, dirname
+import logging
+import multiprocessing
+from os.path import basename, join
 import os
 import re
 import requests
+import shutil
+import signal
 import subprocess
 import sys
+import tempfile
 
 from consulconf import log, configure_logging
-from consulconf import util
+from consulconf import (
+    artifact, buildcache, cache, deleteplan, output, serve, snapshot, stats,
+    transport, util, watch)
 
 
 class DuplicateKeyError(Exception):
@@ -27,6 +35,18 @@ class APIFail(Exception):
     pass
 
 
+class NotFound(APIFail):
+    pass
+
+
+class InheritanceCycleError(Exception):
+    pass
+
+
+# consul rejects transactions that contain more operations than this
+TXN_MAX_OPS = 64
+
+
 def verify_nodups(set1, set2):
     dups = set(set1).intersection(set2)
     if dups:
@@ -51,10 +71,84 @@ def unrecognized_value_error(keypath, jsonfn, basepath, value_type):
     return ValueError(msg)
 
 
+def _locate(keypath, jsonfn, basepath):
+    """Find the key or dict that an _inherit keypath points to.
+    Return it as a node:  (jsonfn, tuple of keys within jsonfn)"""
+    levels = keypath.split('.')
+    jsondata = load_json(jsonfn, basepath)
+    if levels[0] in jsondata:
+        vals = jsondata
+        _current_jsonfn = jsonfn
+    else:
+        _k = levels.pop(0)
+        try:
+            vals = load_json(_k, basepath)
+        except:
+            raise missing_key_error(_k, keypath, jsonfn, basepath)
+        _current_jsonfn = _k
+    for k in levels:
+        try:
+            vals = vals[k]
+        except (KeyError, TypeError):
+            raise missing_key_error(
+                k, keypath=keypath, jsonfn=_current_jsonfn,
+                basepath=basepath)
+    return (_current_jsonfn, tuple(levels))
+
+
+def _node_name(node):
+    return '.'.join((node[0], ) + node[1])
+
+
+# {(basepath, jsonfn, keys): key:value data} of keypaths already resolved.
+# Valid while tree_cache.generation is _RESOLVED_GENERATION[0]
+_RESOLVED = {}
+_RESOLVED_GENERATION = [None]
+_RESOLVING = set()
+
+
+def _resolve_node(node, basepath):
+    """Resolve the key or dict a keypath points to, following its own
+    _inherit keypaths.  Each node is resolved only once"""
+    memokey = (basepath, ) + node
+    if _RESOLVED_GENERATION[0] != tree_cache.generation:
+        _RESOLVED.clear()  # the json data they came from may have changed
+        _RESOLVED_GENERATION[0] = tree_cache.generation
+    if memokey in _RESOLVED:
+        return _RESOLVED[memokey]
+    if memokey in _RESOLVING:
+        raise InheritanceCycleError(
+            "%s inherits from itself" % _node_name(node))
+    jsonfn, levels = node
+    vals = load_json(jsonfn, basepath)
+    for k in levels:
+        vals = vals[k]
+    _RESOLVING.add(memokey)
+    try:
+        if not levels:
+            rv = _parse_root(vals, jsonfn, basepath)
+        elif isinstance(vals, dict):
+            rv = _parse_child(vals, jsonfn, basepath)
+        else:
+            if isinstance(vals, bytes):
+                vals = vals.decode()  # cast to str
+            if not isinstance(vals, (str, bytes)):
+                raise unrecognized_value_error(
+                    keypath=_node_name(node), jsonfn=jsonfn,
+                    basepath=basepath, value_type=type(vals))
+            rv = {levels[-1]: vals}
+    finally:
+        _RESOLVING.discard(memokey)
+    _RESOLVED[memokey] = rv
+    return rv
+
+
 def fetch_values(keys, jsonfn, basepath):
     """Find values for given list of key paths.
     Search first in the current (given) json file,
     and otherwise search for the value(s) identified by the key path.
+    If a key path points to a dict that has its own _inherit keypaths,
+    those are resolved too.
 
     `keys` a list of key paths that identify where specific values exist.
         keypaths may point to a specific key or dictionary of key: value pairs
@@ -66,93 +160,322 @@ def fetch_values(keys, jsonfn, basepath):
     `basepath` the directory or url where `jsonfn` and other json files exist
     """
     union = dict()
-    jsondata = load_json(jsonfn, basepath)
     for keypath in keys:
-        levels = keypath.split('.')
+        vals = _resolve_node(_locate(keypath, jsonfn, basepath), basepath)
+        verify_nodups(set1=union, set2=vals)
+        union.update(vals)
+    return {k: str(v) for k, v in union.items()}
 
-        if levels[0] in jsondata:
-            vals = jsondata
-            _current_jsonfn = jsonfn
-        else:
-            _k = levels.pop(0)
-            try:
-                vals = load_json(_k, basepath)
-            except:
-                raise missing_key_error(_k, keypath, jsonfn, basepath)
-            if levels:
-                _current_jsonfn = levels[0]
-        while levels:
-            k = levels.pop(0)
-            try:
-                vals = vals[k]
-            except KeyError:
-                raise missing_key_error(
-                    k, keypath=keypath, jsonfn=_current_jsonfn,
-                    basepath=basepath)
-        if isinstance(vals, dict):
-            verify_nodups(set1=union, set2=vals)
-            union.update(vals)
-        else:
-            if isinstance(vals, bytes):
-                vals = vals.decode()  # cast to str
-            if isinstance(vals, (str, bytes)):
-                verify_nodups(set1=union, set2=[vals])
-                union.update({k: vals})
+
+def _inherit_nodes(jsondata, jsonfn, levels=()):
+    """Yield (node, keypaths) for each dict in a json file with _inherit"""
+    if '_inherit' in jsondata:
+        yield ((jsonfn, levels), jsondata['_inherit'])
+    for k, v in jsondata.items():
+        if isinstance(v, dict):
+            for x in _inherit_nodes(v, jsonfn, levels + (k, )):
+                yield x
+
+
+def inherit_graph(files, basepath):
+    """Find every _inherit keypath in the given files.
+    Return a dict mapping each dict that defines _inherit to the keys or
+    dicts it inherits from, where each is a node:  (jsonfn, tuple of keys).
+
+    Raise a KeyError if any keypath does not point to anything
+    """
+    graph = {}
+    for jsonfn in files:
+        for node, keys in _inherit_nodes(load_json(jsonfn, basepath), jsonfn):
+            graph[node] = [_locate(keypath, jsonfn, basepath)
+                           for keypath in keys]
+    return graph
+
+
+def inherit_order(graph):
+    """Sort the nodes of an inherit_graph so that each node comes after
+    the nodes it inherits from.  Raise InheritanceCycleError if nodes
+    inherit from each other"""
+    order = []
+    done = set()
+    for root in sorted(graph):
+        if root in done:
+            continue
+        stack = [(root, iter(graph[root]))]
+        while stack:
+            node, parents = stack[-1]
+            for parent in parents:
+                path = [n for n, _ in stack]
+                if parent in path:
+                    cycle = path[path.index(parent):] + [parent]
+                    msg = "Found a cycle of _inherit keypaths"
+                    log.error(msg, extra=dict(
+                        cycle=[_node_name(n) for n in cycle]))
+                    raise InheritanceCycleError("%s: %s" % (
+                        msg, ' -> '.join(_node_name(n) for n in cycle)))
+                if parent not in done:
+                    stack.append((parent, iter(graph.get(parent, ()))))
+                    break
             else:
-                raise unrecognized_value_error(
-                    keypath=keypath, jsonfn=_current_jsonfn, basepath=basepath,
-                    value_type=type(vals))
-    return {k: str(v) for k, v in union.items()}
+                stack.pop()
+                done.add(node)
+                order.append(node)
+    return order
+
+
+def file_dependencies(jsonfn, basepath):
+    """Return the set of other files that the _inherit keypaths in a file
+    point to"""
+    graph = inherit_graph([jsonfn], basepath)
+    return set(
+        parent[0] for parents in graph.values() for parent in parents
+    ).difference([jsonfn])
+
+
+def resolve_inheritance(files, basepath):
+    """Check all _inherit keypaths in the given files up front, and resolve
+    each key or dict that is inherited from exactly once, in dependency
+    order.  Raise a KeyError for keypaths that don't point to anything
+    and an InheritanceCycleError for cycles"""
+    graph = inherit_graph(files, basepath)
+    inherited = set(parent for parents in graph.values() for parent in parents)
+    for node in inherit_order(graph):
+        if node in inherited:
+            _resolve_node(node, basepath)
+
+
+# {basepath: {jsonfn: jsondata}} for consul prefixes fetched by prefetch()
+_PREFETCHED = {}
+# {basepath: X-Consul-Index} of the data in _PREFETCHED
+_PREFETCHED_INDEX = {}
+# the json data of each file, as loaded by load_json.  Unbounded unless
+# `consulconf serve --cache_maxsize` bounds it.  A run reads each file more
+# than once, so runs pin the cache and evict only when they are done
+tree_cache = cache.TreeCache(maxsize=None)
+
+
+def clear_cache():
+    """Forget all key:value data that was loaded or prefetched so far"""
+    _PREFETCHED.clear()
+    _PREFETCHED_INDEX.clear()
+    _forget_loaded()
+
+
+def _forget_loaded():
+    tree_cache.clear()
+    _RESOLVED.clear()
+
+
+def _consul_entries(resp):
+    """Decode the key:value pairs in a recursive GET response from consul"""
+    for x in resp.json():
+        v = base64.b64decode(x['Value'] or '')
+        yield x['Key'], v.decode() if isinstance(v, bytes) else v
+
+
+# consul stores lists as json encoded strings under these keys
+_LIST_KEYS = ('_inherit', '_modify')
+
+
+def _relative_keys(prefix, items):
+    """Remove "prefix/" from the start of each key, and any trailing slash"""
+    n = len(prefix) + 1 if prefix else 0
+    for k, v in items:
+        yield k[n:].rstrip('/'), v
+
+
+def _build_json(items):
+    """Rebuild the json data of one file from the (key, value) pairs stored
+    in consul, where keys are relative to the file's directory in consul"""
+    jsondata = {}
+    for k, v in items:
+        if not k:
+            continue
+        levels = k.split('/')
+        curdct = jsondata
+        for level in levels[:-1]:
+            nextdct = curdct.get(level)
+            if nextdct is None:
+                nextdct = curdct[level] = {}
+            curdct = nextdct
+        leaf = levels[-1]
+        if leaf in _LIST_KEYS:
+            # if reading raw data from consul, it doesn't load lists properly
+            curdct[leaf] = json.loads(v) if v else []
+        elif v:
+            curdct[leaf] = v
+        elif leaf not in curdct:  # empty dir, unless we saw its keys already
+            curdct[leaf] = {}
+    return jsondata
+
+
+def prefetch(basepath, index=None, wait=None):
+    """Fetch all key:value data under a consul url with one recursive GET
+    and split it into the json data of each file.  Subsequent calls to
+    load_json(..., basepath) read from memory rather than from consul.
+
+    `index` and `wait` - if given, make a blocking query that waits up to
+        `wait` seconds for the data to change since consul's `index`
+
+    Return the sorted list of file names found under `basepath`
+    """
+    basepath = '%s/' % basepath.rstrip('/')
+    kwargs = dict(params={'recurse': True})
+    if index is not None:
+        kwargs['params'].update(index=index, wait='%ss' % int(wait))
+        # consul adds up to wait/16 of random jitter to blocking queries
+        kwargs['timeout'] = wait + wait / 16. + transport.DEFAULTS['timeout']
+    with stats.phase('fetch'):
+        resp = transport.read(basepath, **kwargs)
+    if not resp.ok:
+        raise APIFail(
+            "Could not get known app config data from Consul: %s"
+            % resp.content)
+    _, prefix = split_kv_url(basepath)
+    items = {}
+    with stats.phase('parse'):
+        for key, value in _relative_keys(prefix, _consul_entries(resp)):
+            jsonfn, _, k = key.partition('/')
+            items.setdefault(jsonfn, []).append((k, value))
+        items.pop('', None)
+        _PREFETCHED[basepath] = {
+            jsonfn: _build_json(items[jsonfn]) for jsonfn in items}
+    _PREFETCHED_INDEX[basepath] = int(resp.headers.get('X-Consul-Index', 0))
+    tree_cache.invalidate(
+        basepath=basepath, older_than=_PREFETCHED_INDEX[basepath])
+    return sorted(items)
+
+
+def consul_index(basepath):
+    """Cheaply get consul's X-Consul-Index for the data under a consul url.
+    The index changes whenever a key under the url changes"""
+    resp = transport.read(
+        '%s/' % basepath.rstrip('/'),
+        params={'keys': True, 'separator': '/'})
+    if not resp.ok and resp.status_code != 404:
+        raise APIFail(
+            "Could not get the index of config data from Consul: %s"
+            % resp.content)
+    return int(resp.headers['X-Consul-Index'])
+
+
+def list_consul_files(basepath):
+    """List the names of the files under a consul url without fetching
+    their keys"""
+    resp = transport.read(
+        '%s/' % basepath.rstrip('/'),
+        params={'keys': True, 'separator': '/'})
+    if resp.status_code == 404:
+        return []
+    if not resp.ok:
+        raise APIFail(
+            "Could not list config files in Consul: %s" % resp.content)
+    _, prefix = split_kv_url(basepath)
+    return sorted(set(
+        k for k, _ in _relative_keys(prefix, ((x, None) for x in resp.json()))
+        if k))
+
+
+def poll_changes(basepath, wait):
+    """Wait up to `wait` seconds for data under consul url `basepath` to
+    change, and then reload it.  Return the set of files that changed"""
+    basepath = '%s/' % basepath.rstrip('/')
+    if basepath not in _PREFETCHED:
+        prefetch(basepath)
+    old = _PREFETCHED[basepath]
+    prefetch(basepath, index=_PREFETCHED_INDEX[basepath], wait=wait)
+    new = _PREFETCHED[basepath]
+    return set(
+        jsonfn for jsonfn in set(old).union(new)
+        if old.get(jsonfn) != new.get(jsonfn))
+
+
+def _is_missing(err):
+    return isinstance(err, NotFound) or (
+        isinstance(err, (IOError, OSError)) and err.errno == errno.ENOENT)
 
 
-@util.cached
 def load_json(jsonfn, basepath):
+    """Return the json data of a file, from tree_cache if possible.
+    Files that do not exist are cached too, and raise the same error again"""
+    try:
+        return tree_cache.get(jsonfn, basepath)
+    except KeyError:
+        pass
+    # stat before reading, so a file that changes meanwhile gets a new
+    # version when it is read again
+    version = _file_version(jsonfn, basepath)
+    try:
+        jsondata, index = _load_json(jsonfn, basepath)
+    except Exception as err:
+        if _is_missing(err):
+            tree_cache.put_missing(jsonfn, basepath, err)
+        raise
+    tree_cache.put(jsonfn, basepath, jsondata, index, version=version)
+    return jsondata
+
+
+def _file_version(jsonfn, basepath):
+    """Return the modification time and size of a local json file, or None
+    for consul data, whose version is its index"""
+    if basepath in _PREFETCHED or basepath.startswith('http://'):
+        return None
     fp = join(basepath, jsonfn)
-    log.debug('load json data', extra=dict(basepath=fp))
-    if basepath.startswith('http://'):
-        resp = requests.get('%s/' % fp.rstrip('/'), params={'recurse': True})
+    try:
+        st = os.stat(fp if fp.endswith('.json') else '%s.json' % fp)
+    except OSError:
+        return None
+    return (st.st_mtime, st.st_size)
+
+
+def _load_json(jsonfn, basepath):
+    """Return (json data, consul index of the data or None)"""
+    fp = join(basepath, jsonfn)
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug('load json data', extra=dict(basepath=fp))
+    if basepath in _PREFETCHED:
+        try:
+            return _PREFETCHED[basepath][jsonfn], _PREFETCHED_INDEX[basepath]
+        except KeyError:
+            raise NotFound(
+                'Failed to get key:value data from Consul: %s not found'
+                % fp)
+    elif basepath.startswith('http://'):
+        with stats.phase('fetch'):
+            resp = transport.read(
+                '%s/' % fp.rstrip('/'), params={'recurse': True})
+        if resp.status_code == 404:
+            raise NotFound(
+                'Failed to get key:value data from Consul: %s not found'
+                % fp)
         if not resp.ok:
             raise APIFail(
                 'Failed to get key:value data from Consul: %s' % resp.content)
-        _jsondata = (
-            (re.sub('.*?/%s/(.*?)/?$' % jsonfn, r'\1', x['Key']),
-             base64.b64decode(x['Value'] or ''))
-            for x in resp.json())
-        _jsondata = ((k, v.decode() if isinstance(v, bytes) else v)
-                     for k, v in _jsondata)
-        jsondata = {}
-        for k, v in _jsondata:
-            if not k:
-                continue
-            levels = k.split('/')
-            curdct = jsondata
-            while len(levels) > 1:
-                lastkey = levels.pop(0)
-                curdct = curdct.setdefault(lastkey, {})
-            # if reading raw data from consul, it doesn't load lists properly
-            if any(k.endswith(x) for x in ['_inherit', '_modify']):
-                v = json.loads(v)
-            if v:
-                curdct[levels.pop(0)] = v
-            else:
-                if any(k.endswith(x) for x in ['_inherit', '_modify']):
-                    curdct[levels.pop(0)] = []
-                else:
-                    curdct[levels.pop(0)] = {}
+        _, prefix = split_kv_url(fp)
+        with stats.phase('parse'):
+            jsondata = _build_json(
+                _relative_keys(prefix, _consul_entries(resp)))
+        # the index of a recursive GET is the largest ModifyIndex under it
+        return jsondata, int(resp.headers.get('X-Consul-Index', 0))
     else:  # assume its a local filepath
         if not fp.endswith('.json'):
-            log.debug(
-                "Appended .json to a json filename", extra=dict(jsonfn=jsonfn))
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug("Appended .json to a json filename",
+                          extra=dict(jsonfn=jsonfn))
             fp = "%s.json" % fp
 
         try:
-            jsondata = json.load(open(fp))
+            with stats.phase('fetch'):
+                with open(fp) as fin:
+                    content = fin.read()
+            with stats.phase('parse'):
+                jsondata = json.loads(content)
         except:
             log.error(
                 "Could not load json file. It probably contains invalid json",
                 extra=dict(fp=fp))
             raise
-    return jsondata
+    return jsondata, None
 
 
 def _update_dct(consulvals, kkey, vval, jsonfn, basepath):
@@ -163,9 +486,10 @@ def _update_dct(consulvals, kkey, vval, jsonfn, basepath):
     elif kkey == '_modify':
         raise NotImplementedError("TODO")
     elif kkey.startswith('_'):
-        log.debug(
-            "skipping key because it starts with an underscore",
-            extra=dict(key=kkey))
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug(
+                "skipping key because it starts with an underscore",
+                extra=dict(key=kkey))
     elif kkey in consulvals:
         raise DuplicateKeyError(kkey)
     elif isinstance(vval, (list, dict)):
@@ -175,126 +499,935 @@ def _update_dct(consulvals, kkey, vval, jsonfn, basepath):
         consulvals[kkey] = str(vval)
 
 
-def parse(jsonfn, basepath):
-    jsondata = load_json(jsonfn, basepath)
-
-    basekey = basename(jsonfn)
-
+def _parse_root(jsondata, jsonfn, basepath):
+    """Resolve the namespace defined by the root of a json file"""
     consulvals = {}
     for consulkey, keydata in jsondata.items():
         if consulkey.startswith('_'):
             _update_dct(consulvals, consulkey, keydata, jsonfn, basepath)
         elif not isinstance(keydata, dict):
             consulvals[consulkey] = str(keydata)
-        else:
+    return consulvals
+
+
+def _parse_child(keydata, jsonfn, basepath):
+    """Resolve the namespace defined by a dict at the root of a json file"""
+    consulvals = {}
+    for kkey, vval in keydata.items():
+        _update_dct(consulvals, kkey, vval, jsonfn, basepath)
+    return consulvals
+
+
+def parse(jsonfn, basepath):
+    jsondata = load_json(jsonfn, basepath)
+
+    basekey = basename(jsonfn)
+
+    for consulkey, keydata in jsondata.items():
+        if isinstance(keydata, dict) and not consulkey.startswith('_'):
             # generate the dict for this consulkey
-            consulvals2 = {}
-            for kkey, vval in keydata.items():
-                _update_dct(consulvals2, kkey, vval, jsonfn, basepath)
-            yield (join(basekey, consulkey), consulvals2)
-    yield (basekey, consulvals)
+            yield (join(basekey, consulkey),
+                   _parse_child(keydata, jsonfn, basepath))
+    yield (basekey, _parse_root(jsondata, jsonfn, basepath))
 
 
-def put_to_consul(kvs, puturl):
-    if not puturl.startswith('http://'):
-        assert puturl, puturl
-        puturl = 'http://%s' % puturl
+def _split_namespace(name, basepath):
+    jsonfn, _, consulkey = name.partition('/')
+    jsondata = load_json(jsonfn, basepath)
+    if not consulkey:
+        return jsonfn, jsondata, jsondata
+    keydata = jsondata.get(consulkey)
+    if consulkey.startswith('_') or not isinstance(keydata, dict):
+        raise KeyError("Unrecognized namespace: %s" % name)
+    return jsonfn, jsondata, keydata
 
-    def check_put(url, data):
+
+def resolve_namespace(name, basepath):
+    """Resolve one namespace, ie "ns1" or "test/app20", without resolving
+    the other namespaces defined in the same file"""
+    jsonfn, jsondata, keydata = _split_namespace(name, basepath)
+    if keydata is jsondata:
+        return _parse_root(jsondata, jsonfn, basepath)
+    return _parse_child(keydata, jsonfn, basepath)
+
+
+def resolve_namespaces(names, basepath):
+    """Resolve only the given namespaces.  Load only the files that define
+    them and the files that their _inherit keypaths point to.
+    Return a dict of {name: key:value data}"""
+    log.info("Resolve namespaces", extra=dict(namespaces=names))
+    return {name: resolve_namespace(name, basepath) for name in names}
+
+
+def namespace_sources(name, basepath):
+    """Return the set of files that a namespace gets its data from:  the file
+    that defines it and the files that its _inherit keypaths point to,
+    following the _inherit keypaths of what they point to in turn"""
+    jsonfn, _, consulkey = name.partition('/')
+    _split_namespace(name, basepath)  # raise KeyError for bad names
+    stack = [(jsonfn, (consulkey, ) if consulkey else ())]
+    seen = set(stack)
+    while stack:
+        node_jsonfn, levels = stack.pop()
+        vals = load_json(node_jsonfn, basepath)
+        for k in levels:
+            vals = vals[k]
+        if not isinstance(vals, dict):
+            continue
+        for keypath in vals.get('_inherit', []):
+            parent = _locate(keypath, node_jsonfn, basepath)
+            if parent not in seen:
+                seen.add(parent)
+                stack.append(parent)
+    return set(node[0] for node in seen)
+
+
+def _check_put(url, data, session=None):
+    if log.isEnabledFor(logging.DEBUG):
         log.debug("consul put", extra=dict(url=url, data=data))
-        if isinstance(data, bytes):
-            data = data.decode()
-        elif data is None:
-            data = ""
-        resp = requests.put(url, data=data)
-        if not resp.ok:
-            raise APIFail(
-                "failed to PUT to consul: %s" % resp.content)
+    if isinstance(data, bytes):
+        data = data.decode()
+    elif data is None:
+        data = ""
+    resp = transport.put(url, data=data, session=session)
+    if not resp.ok:
+        raise APIFail(
+            "failed to PUT to consul: %s" % resp.content)
+
+
+def _run_all(func, items, concurrency, what):
+    """Call func(item) for each item, using `concurrency` threads if > 1.
+    If any calls fail, log every failure and then raise for the first failed
+    item, so that failures are reported the same way regardless of which
+    thread finished first"""
+    if concurrency <= 1:
+        for item in items:
+            func(item)
+        return
+    errors = util.run_concurrently(func, items, concurrency)
+    if errors:
+        for item, err in errors:
+            log.error(
+                "Failed to %s" % what, extra=dict(item=item, error=err))
+        item, err = errors[0]
+        raise APIFail("%s %s requests failed.  First failure, %s: %s" % (
+            len(errors), what, item, err))
+
+
+def _iter_puts(kvs):
+    """Yield the (key, value) pairs that represent `kvs` in consul.
+    Keys are relative to the url we put to.  Empty namespaces are represented
+    by an empty directory marker, ie ('namespace/', None)"""
     for key1 in kvs:
         if isinstance(kvs[key1], dict):
             for key2, val in kvs[key1].items():
-                url = join(puturl, key1, key2)
-                # TODO: parallelize?
-                check_put(url, data=val)
+                yield (join(key1, key2), val)
             if not kvs[key1]:
-                check_put('%s/' % join(puturl, key1).rstrip('/'), data=None)
+                yield ('%s/' % key1.rstrip('/'), None)
         else:
-            url = join(puturl, key1)
-            check_put(url, data=str(kvs[key1]))
+            yield (key1, str(kvs[key1]))
 
 
-def parse_raw(jsonfn, basepath):
-    rv = {}  # resulting flattened dict
-    curdct = load_json(jsonfn, basepath)
-    keystack = {jsonfn: {'keys': list(curdct.keys()), 'dict': curdct}}
-    rvkey = jsonfn
-    while keystack:
-        try:
-            k = keystack[rvkey]['keys'].pop()
-        except IndexError:  # basecase: no more keys to pop off stack
-            del keystack[rvkey]
-            if not keystack:
-                break
-            rvkey = next(iter(keystack.keys()))
-            curdct = keystack[rvkey]['dict']
+def split_kv_url(url):
+    """Split a consul key:value url into the agent's address and a key prefix
+        ie.  http://127.0.0.1:8500/v1/kv/a/b --> http://127.0.0.1:8500, a/b
+    """
+    agent, sep, prefix = url.partition('/v1/kv')
+    if not sep:
+        raise ValueError(
+            "Expected a consul key:value url like"
+            " http://127.0.0.1:8500/v1/kv/...  Got: %s" % url)
+    return agent, prefix.strip('/')
+
+
+def _txn_value(data):
+    if data is None:
+        data = b''
+    elif not isinstance(data, bytes):
+        data = str(data).encode('utf-8')
+    return base64.b64encode(data).decode('ascii')
+
+
+def _batches(iterable, batch_size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def run_txn(ops, puturl, batch_size=TXN_MAX_OPS, session=None):
+    """Apply key:value operations to consul using the transaction api.
+    Each batch of operations is all-or-nothing, but batches that were applied
+    before a failed batch stay applied.
+
+    `ops` an iterable of (verb, key, value), where verb is a consul txn verb
+        like "set" or "delete-tree" and key is relative to `puturl`
+    `puturl` a consul key:value url, ie http://127.0.0.1:8500/v1/kv/a
+    `batch_size` number of operations per transaction.  Consul rejects
+        transactions with more than 64 operations.
+    `session` the requests.Session to send them with.  Defaults to the
+        shared session of consulconf.transport
+    """
+    agent, prefix = split_kv_url(puturl)
+    url = '%s/v1/txn' % agent
+    n_batches = 0
+    for n_batches, batch in enumerate(_batches(ops, batch_size), 1):
+        payload = []
+        for verb, key, value in batch:
+            op = {'Verb': verb, 'Key': join(prefix, key)}
+            if verb in ('set', 'cas'):
+                op['Value'] = _txn_value(value)
+            payload.append({'KV': op})
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("consul txn", extra=dict(
+                url=url, batch=n_batches, num_ops=len(payload)))
+        resp = transport.put(url, data=json.dumps(payload), session=session)
+        if not resp.ok:
+            msg = "Consul transaction failed.  No keys in this batch were set"
+            log.error(msg, extra=dict(
+                url=url, batch=n_batches, num_ops=len(payload),
+                first_key=batch[0][1], last_key=batch[-1][1],
+                batches_applied=n_batches - 1))
+            raise APIFail(
+                "%s: batch %s (keys %s .. %s): %s" % (
+                    msg, n_batches, batch[0][1], batch[-1][1], resp.content))
+    return n_batches
+
+
+def put_to_consul(kvs, puturl, txn=False, concurrency=1, session=None):
+    """Write the namespaces in `kvs` to consul under `puturl`.
+
+    `txn` if True, group writes into transactions instead of sending one
+        HTTP PUT per key
+    `concurrency` number of PUT requests to send in parallel
+    `session` the requests.Session to use, if not the shared one
+    """
+    put_items(_iter_puts(kvs), puturl, txn=txn, concurrency=concurrency,
+              session=session)
+
+
+def put_items(items, puturl, txn=False, concurrency=1, session=None):
+    """Write (key, value) pairs to consul under `puturl`, as put_to_consul
+    does.  `items` is consumed lazily, so writes start with the first pair
+    and only a batch of pairs is held in memory at a time"""
+    if not puturl.startswith('http://'):
+        assert puturl, puturl
+        puturl = 'http://%s' % puturl
+
+    with stats.phase('push'):
+        if txn:
+            run_txn((('set', key, val) for key, val in items), puturl,
+                    session=session)
+            return
+        _run_all(
+            lambda kv: _check_put(
+                join(puturl, kv[0]), data=kv[1], session=session),
+            items, concurrency, 'PUT')
+
+
+def fetch_existing(puturl, session=None):
+    """Fetch every key:value pair under `puturl` with one recursive GET.
+    Return a dict of {key: value} with keys relative to `puturl`"""
+    resp = transport.get(
+        '%s/' % puturl.rstrip('/'), params={'recurse': True}, session=session)
+    if resp.status_code == 404:  # nothing there yet
+        return {}
+    if not resp.ok:
+        raise APIFail(
+            "Could not get existing key:value data from Consul: %s"
+            % resp.content)
+    _, prefix = split_kv_url(puturl)
+    existing = {}
+    for x in resp.json():
+        key = x['Key'][len(prefix):].lstrip('/') if prefix else x['Key']
+        if not key:  # the marker for the prefix itself
             continue
+        existing[key] = _as_text(base64.b64decode(x['Value'] or ''))
+    return existing
+
+
+def _as_text(val):
+    if val is None:
+        return ''
+    if isinstance(val, bytes):
+        return val.decode()
+    return str(val)
+
+
+SyncPlan = namedtuple('SyncPlan', ['puts', 'deletes', 'unchanged'])
 
-        v = curdct[k]
-        if isinstance(v, dict):
-            rvkey = join(rvkey, k)
-            keystack[rvkey] = {'keys': list(v.keys()), 'dict': v}
-            curdct = v
-        else:
-            if isinstance(v, list):
-                v = json.dumps(v)
-            rv[join(rvkey, k)] = v
-    return rv
 
+def own_directories(kvs):
+    """Return the set of directories whose keys the namespaces (or raw keys)
+    in `kvs` define:  each namespace, or the parent directory of a raw key.
+    Keys in their subdirectories belong to other namespaces"""
+    return set(
+        name if isinstance(value, dict) else name.rpartition('/')[0]
+        for name, value in kvs.items())
 
-def delete_directories(keys, delete_excludes, puturl):
-    deleted = set()
-    for k in sorted(keys):
+
+def plan_sync(kvs, existing, delete_excludes=(), delete_within=None):
+    """Compare the namespaces in `kvs` to the `existing` key:value pairs
+    in consul and decide which keys need to be written or removed.
+
+    Only keys in the directories that --delete would clean (see
+    deleteplan.targets) are deleted, so keys that other inputs push to the
+    same url are left alone.
+
+    `delete_excludes` never delete keys starting with these prefixes
+    `delete_within` if given, only delete the keys directly inside these
+        directories (ie own_directories of the namespaces selected by
+        --filterns), not keys in their subdirectories
+    """
+    desired = {k: _as_text(v) for k, v in _iter_puts(kvs)}
+    puts = sorted(
+        (k, v) for k, v in desired.items()
+        if k not in existing or existing[k] != v)
+    targets = deleteplan.targets(list(kvs))
+    scope = tuple('%s/' % t for t in targets)
+    targets = set(targets)
+    if delete_within is not None:
+        # "ns/" marks an empty namespace.  Its directory is "ns"
+        delete_within = set(x.rstrip('/') for x in delete_within)
+    deletes = []
+    for k in sorted(set(existing).difference(desired)):
         if any(k.startswith(x) for x in delete_excludes):
             continue
-        if any(k.startswith(x) for x in deleted):
+        if not (k in targets or k.startswith(scope)):
+            continue
+        if delete_within is not None and \
+                k.rpartition('/')[0] not in delete_within:
             continue
-        k = dirname(k) or k
-        url = join(puturl, k)
-        log.warn('consul delete', extra=dict(url=url))
-        resp = requests.delete(url, params={'recurse': True})
-        if not resp.status_code == 200:
-            msg = "Could not delete directory from Consul"
-            log.error(msg, extra=dict(url=url))
-            raise APIFail('%s: %s' % (msg, resp.content))
-        deleted.add(k)
-    return deleted
+        deletes.append(k)
+    return SyncPlan(
+        puts=puts, deletes=deletes, unchanged=len(desired) - len(puts))
+
+
+def print_sync_plan(plan, puturl):
+    # one print call, so that plans of targets pushed to concurrently do not
+    # interleave
+    print('\n'.join(
+        ["sync %s: %s to put, %s to delete, %s unchanged" % (
+            puturl, len(plan.puts), len(plan.deletes), plan.unchanged)]
+        + ["  put     %s" % k for k, _ in plan.puts]
+        + ["  delete  %s" % k for k in plan.deletes]))
+
+
+def sync_to_consul(kvs, puturl, delete_excludes=(), delete_within=None,
+                   dry_run=False, txn=False, concurrency=1, session=None):
+    """Make the data under `puturl` match `kvs` by writing only new or
+    changed keys and removing keys that no longer exist in `kvs`.
+    Print a summary of the changes.  If `dry_run`, make no changes.
+    Return the SyncPlan"""
+    puturl = to_url(puturl)
+    with stats.phase('fetch'):
+        existing = fetch_existing(puturl, session=session)
+    plan = plan_sync(
+        kvs, existing, delete_excludes=delete_excludes,
+        delete_within=delete_within)
+    print_sync_plan(plan, puturl)
+    if dry_run:
+        return plan
+    if txn:
+        with stats.phase('push'):
+            run_txn(
+                [('set', k, v) for k, v in plan.puts]
+                + [('delete', k, None) for k in plan.deletes], puturl,
+                session=session)
+        return plan
+    with stats.phase('push'):
+        _run_all(
+            lambda kv: _check_put(
+                join(puturl, kv[0]), data=kv[1], session=session),
+            plan.puts, concurrency, 'PUT')
+    with stats.phase('delete'):
+        _run_all(
+            lambda k: _check_delete(join(puturl, k), session=session),
+            plan.deletes, concurrency, 'DELETE')
+    return plan
+
+
+def _check_delete(url, recurse=False, session=None):
+    if log.isEnabledFor(logging.WARNING):
+        log.warning('consul delete', extra=dict(url=url))
+    resp = transport.delete(
+        url, params={'recurse': True} if recurse else None, session=session)
+    if not resp.status_code == 200:
+        msg = "Could not delete from Consul"
+        log.error(msg, extra=dict(url=url))
+        raise APIFail('%s: %s' % (msg, resp.content))
+
+
+def iter_raw(jsondata, prefix):
+    """Yield the (key, value) pairs of nested json data, flattened into
+    /-separated keys that start with `prefix`.  Lists are json encoded and
+    empty dicts are left out"""
+    stack = [(prefix, iter(jsondata.items()))]
+    while stack:
+        path, items = stack[-1]
+        for k, v in items:
+            if isinstance(v, dict):
+                stack.append((join(path, k), iter(v.items())))
+                break
+            if isinstance(v, list):
+                v = json.dumps(v)
+            yield join(path, k), v
+        else:
+            stack.pop()
+
+
+def parse_raw(jsonfn, basepath):
+    """Return the raw key:value pairs of a file as a flat dict"""
+    return dict(iter_raw(load_json(jsonfn, basepath), jsonfn))
+
+
+def stream_raw(files, basepath):
+    """Yield (jsonfn, json data) for each file, reading one file at a time.
+    The data is not kept in tree_cache, so a raw copy of many files needs no
+    more memory than its largest file"""
+    for jsonfn in files:
+        try:
+            jsondata = tree_cache.get(jsonfn, basepath)
+        except KeyError:
+            jsondata, _ = _load_json(jsonfn, basepath)
+        yield jsonfn, jsondata
+
+
+def copy_raw(files, basepath, puturl, filterns=None, delete=False,
+             delete_excludes=(), txn=False, concurrency=1, show_plan=False):
+    """Copy the raw key:value pairs of `files` to consul under `puturl` as
+    they are read, instead of reading every file before writing.
+
+    `filterns` only copy keys that match this regex
+    `delete` if True, before writing the keys of a file, delete the
+        directories they are written to (see delete_directories)
+    `show_plan` if True, print each delete plan to stdout
+    Return the number of keys written
+    """
+    regex = re.compile(filterns) if filterns else None
+    written = [0]
+
+    def pairs(jsonfn, jsondata):
+        for key, val in iter_raw(jsondata, jsonfn):
+            if regex is None or regex.search(key):
+                yield key, val
+
+    def items():
+        for jsonfn, jsondata in stream_raw(files, basepath):
+            if delete:
+                keys = [key for key, _ in pairs(jsonfn, jsondata)]
+                if keys:
+                    delete_directories(
+                        keys, delete_excludes, puturl,
+                        concurrency=concurrency, txn=txn,
+                        show_plan=show_plan)
+            for key, val in pairs(jsonfn, jsondata):
+                written[0] += 1
+                yield key, str(val)
+
+    put_items(items(), puturl, txn=txn, concurrency=concurrency)
+    log.info("Copied raw key:value pairs", extra=dict(
+        num_keys=written[0], num_files=len(files)))
+    return written[0]
+
+
+def list_keys(puturl, path='', session=None):
+    """Return the keys under directory `path` of a consul url, relative to
+    the url, without fetching their values"""
+    _, prefix = split_kv_url(puturl)
+    resp = transport.get(
+        '%s/' % join(puturl, path).rstrip('/'), params={'keys': True},
+        session=session)
+    if resp.status_code == 404:
+        return []
+    if not resp.ok:
+        raise APIFail("Could not list keys in Consul: %s" % resp.content)
+    n = len(prefix) + 1 if prefix else 0
+    return [k[n:] for k in resp.json()]
+
+
+def print_delete_plan(plan, puturl):
+    print('\n'.join(
+        ["delete %s: %s directories, %s keys, %s excluded keys kept" % (
+            puturl, len(plan.trees), len(plan.keys), plan.kept)]
+        + ["  delete  %s (recursive)" % k for k in plan.trees]
+        + ["  delete  %s" % k for k in plan.keys]))
+
+
+def delete_directories(keys, delete_excludes, puturl, concurrency=1,
+                       txn=False, session=None, show_plan=False):
+    """Delete the directories that the namespaces (or raw keys) in `keys`
+    are pushed to, except for paths that start with one of
+    `delete_excludes`.  Excluded paths can be at any depth.
+    Return the set of deleted paths
+
+    `txn` if True, send the deletes in transactions of up to 64 deletes
+    `concurrency` otherwise, number of DELETE requests to send in parallel
+    `show_plan` if True, print the plan to stdout before deleting anything.
+        Otherwise, only log it
+    """
+    with stats.phase('delete'):
+        plan = deleteplan.plan(
+            keys, delete_excludes,
+            lambda path: list_keys(puturl, path, session=session))
+        if show_plan:
+            print_delete_plan(plan, puturl)
+        else:
+            log.info("Delete plan", extra=dict(
+                puturl=puturl, trees=plan.trees, keys=plan.keys,
+                kept=plan.kept))
+        if txn:
+            run_txn(
+                [('delete-tree', k, None) for k in plan.trees]
+                + [('delete', k, None) for k in plan.keys], puturl,
+                session=session)
+        else:
+            _run_all(
+                lambda op: _check_delete(
+                    join(puturl, op[0]), recurse=op[1], session=session),
+                [(k, True) for k in plan.trees]
+                + [(k, False) for k in plan.keys],
+                concurrency, 'DELETE')
+    return set(k.rstrip('/') for k in plan.trees).union(plan.keys)
+
+
+def input_basepath(inputuri):
+    if inputuri.startswith('http://'):
+        return '%s/' % inputuri.rstrip('/')
+    return inputuri.replace('file://', '')
+
+
+def list_files(basepath, filterns=None, prefetch_data=True):
+    """Return the names of the json files under basepath.  For a consul url,
+    prefetch its data unless it was prefetched already.
+
+    `filterns` a --filterns regex.  If it is anchored with ^, skip the files
+        whose namespaces cannot match it.  Consul data is then fetched file
+        by file, as needed, instead of prefetched
+    `prefetch_data` if False, never prefetch.  Consul data is fetched file by
+        file
+    """
+    prefix = regex_prefix(filterns) if filterns else None
+    with stats.phase('list'):
+        if basepath.startswith('http://'):
+            if basepath in _PREFETCHED:
+                files = sorted(_PREFETCHED[basepath])
+            elif prefix or not prefetch_data:
+                files = list_consul_files(basepath)
+            else:
+                return prefetch(basepath)
+        else:
+            files = [basename(x)
+                     for x in glob.glob(join(basepath, '*.json'))]
+            files = [x[:-5] if x.endswith('.json') else x for x in files]
+    if prefix:
+        files = [x for x in files if file_may_match(x, prefix)]
+        log.info("Skipping files that --filterns cannot match",
+                 extra=dict(prefix=prefix, files=files))
+    return files
+
+
+_REGEX_SPECIAL = frozenset('.^$*+?{}[]()|\\')
+
+
+def regex_prefix(pattern):
+    """Return the literal text that every match of a ^-anchored regular
+    expression starts with, ie "apps/app" for '^apps/app[12]$'.
+    Return None if the pattern is not anchored or may match without it"""
+    if not pattern.startswith('^') or '|' in pattern:
+        return None
+    prefix = []
+    i = 1
+    while i < len(pattern):
+        char = pattern[i]
+        step = 1
+        if char == '\\':
+            char = pattern[i + 1:i + 2]
+            step = 2
+            if not char or char.isalnum():  # \d, \w, \A, ...
+                break
+        elif char in _REGEX_SPECIAL:
+            break
+        if pattern[i + step:i + step + 1] in ('*', '?', '{'):
+            break  # the character is optional
+        prefix.append(char)
+        i += step
+    return ''.join(prefix)
+
+
+def file_may_match(jsonfn, prefix):
+    """Can a namespace from this file ("jsonfn" or "jsonfn/...") start with
+    `prefix`?"""
+    return jsonfn.startswith(prefix) or prefix.startswith('%s/' % jsonfn)
+
+
+def select_namespaces(files, basepath, filterns, raw=False):
+    """Yield the (name, key:value data) pairs of the namespaces in `files`
+    whose names match regex `filterns`.  Only the matching namespaces, and
+    the namespaces they inherit from, are resolved"""
+    regex = re.compile(filterns)
+    for jsonfn in files:
+        if raw:
+            for item in iter_raw(load_json(jsonfn, basepath), jsonfn):
+                if regex.search(item[0]):
+                    yield item
+            continue
+        jsondata = load_json(jsonfn, basepath)
+        names = [join(jsonfn, k) for k, v in jsondata.items()
+                 if isinstance(v, dict) and not k.startswith('_')]
+        names.append(jsonfn)
+        for name in names:
+            if regex.search(name):
+                yield name, resolve_namespace(name, basepath)
+
+
+def parse_all(files, basepath):
+    """Check the inheritance of all files and return all of their
+    namespaces as a dict of {name: key:value data}"""
+    with tree_cache.pinned():  # every file is read in both passes
+        resolve_inheritance(files, basepath)
+        kvs = {}
+        for jsonfn in files:
+            kvs.update(parse(jsonfn, basepath))
+    return kvs
 
 
 def main(ns):
-    configure_logging(ns.log)
+    with tree_cache.pinned():
+        if not ns.stats:
+            return _main(ns)
+        with stats.collect(tree_cache) as collector:
+            try:
+                return _main(ns)
+            finally:
+                stats.write(collector.report(), ns.stats)
 
-    if ns.inputuri.startswith('http://'):
-        basepath = '%s/' % ns.inputuri.rstrip('/')
-        resp = requests.get(
-            basepath, params={'recurse': True, 'keys': True, 'separator': '/'})
-        if not resp.ok:
-            raise APIFail(
-                "Could not get known app config data from Consul: %s"
-                % resp.content)
-        files = [basename(x.rstrip('/')) for x in resp.json()]
-    else:
-        basepath = ns.inputuri.replace('file://', '')
-        files = [basename(x) for x in glob.glob(join(basepath, '*.json'))]
-        files = [x[:-5] if x.endswith('.json') else x for x in files]
+
+def _main(ns):
+    configure_logging(ns.log or ns.log_json, json_lines=ns.log_json)
+    if ns.watch and not (ns.app and ns.inputuri.startswith('http://')):
+        raise ValueError(
+            "--watch only works with --app and a consul url as --inputuri")
+    if ns.exec_app and (ns.watch or not ns.app or not ns.app[1:]):
+        raise ValueError(
+            "--exec only works with --app and a command, and not with --watch")
+    if ns.raw and ns.output_format == 'env':
+        raise ValueError(
+            "--output_format env does not work with --raw, because raw keys"
+            " are not valid shell variable names")
+    _configure_transport(ns)
+    basepath = input_basepath(ns.inputuri)
+
+    if ns.app and not ns.raw and not ns.watch and ns.daemon:
+        with stats.phase('fetch'):
+            kvs = serve.lookup(ns.daemon, basepath, ns.app[0].split('+'))
+        if kvs is not None:
+            return process_output(ns, kvs, basepath)
+    if ns.app and ns.cache_dir and not ns.watch and \
+            basepath.startswith('http://'):
+        with stats.phase('resolve'):
+            kvs = _cached_apps(ns, basepath)
+        return process_output(ns, kvs, basepath)
+
+    if ns.app and not ns.raw:
+        # only load the files that the app's namespaces need
+        with stats.phase('resolve'):
+            kvs = {} if ns.watch else resolve_namespaces(
+                ns.app[0].split('+'), basepath)
+        return process_output(ns, kvs, basepath)
+
+    if ns.raw and len(ns.puturl) == 1 and not (
+            ns.app or ns.dry_run or ns.sync or ns.jobs > 1):
+        # with several targets, read once and push the parsed data instead
+        files = list_files(basepath, ns.filterns, prefetch_data=False)
+        log.info("Copy files", extra=dict(files=files))
+        copy_raw(
+            files, basepath, ns.puturl[0], filterns=ns.filterns,
+            delete=ns.delete, delete_excludes=ns.delete_excludes,
+            txn=ns.txn, concurrency=ns.concurrency, show_plan=True)
+        return
+
+    stream = ns.dry_run and ns.output_format != 'json' and not ns.sync
+    # raw data is streamed one file at a time, so do not prefetch all of it
+    files = list_files(basepath, ns.filterns,
+                       prefetch_data=not (stream and ns.raw))
     log.info("Parse files", extra=dict(files=files))
-    kvs = {}
+    if stream:
+        with stats.phase('resolve'):
+            output.write_stream(
+                _iter_namespaces(ns, files, basepath), ns.output_format,
+                sys.stdout, sort=ns.sort_output, buffer_size=ns.sort_buffer)
+        return
+    with stats.phase('resolve'):
+        kvs = _parse_files(ns, files, basepath)
+    return process_output(ns, kvs, basepath)
+
+
+def _iter_namespaces(ns, files, basepath):
+    """Yield the (name, key:value data) pairs of all files, one file at a
+    time, that match --filterns"""
+    if ns.jobs > 1 or _use_build_cache(ns, basepath):
+        items = iter(_parse_files(ns, files, basepath).items())
+        if ns.filterns:
+            regex = re.compile(ns.filterns)
+            items = (x for x in items if regex.search(x[0]))
+        return items
+    if ns.filterns:
+        return select_namespaces(files, basepath, ns.filterns, raw=ns.raw)
     if ns.raw:
+        return (item for jsonfn, jsondata in stream_raw(files, basepath)
+                for item in iter_raw(jsondata, jsonfn))
+    resolve_inheritance(files, basepath)
+    return (item for jsonfn in files for item in parse(jsonfn, basepath))
+
+
+def _use_build_cache(ns, basepath):
+    return bool(ns.build_cache and not ns.raw
+                and not basepath.startswith('http://'))
+
+
+def _parse_files(ns, files, basepath):
+    """Return the namespaces of all files, as the options in `ns` ask.
+    Namespaces that do not match --filterns may be left out"""
+    kvs = {}
+    if ns.jobs > 1:
+        kvs = parse_parallel(files, basepath, ns.jobs, raw=ns.raw)
+    elif ns.filterns and not _use_build_cache(ns, basepath):
+        kvs = dict(select_namespaces(
+            files, basepath, ns.filterns, raw=ns.raw))
+    elif ns.raw:
         for jsonfn in files:
             kvs.update(parse_raw(jsonfn, basepath))
+    elif _use_build_cache(ns, basepath):
+        kvs, rebuilt = buildcache.build(
+            files, basepath, ns.build_cache,
+            parse=lambda jsonfn: parse(jsonfn, basepath),
+            dependencies=lambda jsonfn: file_dependencies(jsonfn, basepath),
+            validate=lambda files: resolve_inheritance(files, basepath))
+        sys.stderr.write("Rebuilt %s of %s files%s\n" % (
+            len(rebuilt), len(files),
+            ': %s' % ', '.join(rebuilt) if rebuilt else ''))
     else:
-        for jsonfn in files:
-            kvs.update(parse(jsonfn, basepath))
-    return process_output(ns, kvs, basepath)
+        kvs = parse_all(files, basepath)
+    return kvs
+
+
+def serve_main(ns):
+    """Run the daemon behind `consulconf serve`"""
+    configure_logging(ns.log or ns.log_json, json_lines=ns.log_json)
+    _configure_transport(ns)
+    tree_cache.configure(maxsize=ns.cache_maxsize, ttl=ns.cache_ttl)
+    basepath = input_basepath(ns.inputuri)
+
+    def load():
+        if not basepath.startswith('http://'):
+            clear_cache()  # re-read the json files
+        return parse_all(list_files(basepath), basepath)
+
+    if basepath.startswith('http://'):
+        daemon = serve.Daemon(
+            basepath, load, poll=lambda wait: poll_changes(basepath, wait),
+            max_age=ns.max_age)
+    else:
+        daemon = serve.Daemon(basepath, load, interval=ns.refresh_interval,
+                              max_age=ns.max_age)
+    serve.serve_forever(daemon, ns.daemon, wait=ns.poll_wait)
+
+
+ARTIFACT_FORMATS = ('kv', 'env', 'envdir')
+
+
+def compile_apps(apps, basepath, outdir, formats=ARTIFACT_FORMATS):
+    """Resolve each app ahead of time and write its environment to `outdir`,
+    in each of `formats`:
+        kv  a sorted binary file that consulconf.artifact loads
+        env  a .env file of NAME='value' lines
+        envdir  a directory with one file per variable, for envdir(8)
+
+    `apps` namespaces, or namespaces combined with +.  If None, compile
+        every namespace
+    Return the list of paths written
+    """
+    with stats.phase('resolve'):
+        if apps is None:
+            kvs = parse_all(list_files(basepath), basepath)
+            apps = sorted(kvs)
+        else:
+            kvs = resolve_namespaces(
+                set(name for app in apps for name in app.split('+')),
+                basepath)
+    written = []
+    with stats.phase('compile'):
+        if not os.path.isdir(outdir):
+            os.makedirs(outdir)
+        for app in apps:
+            env = {k: _as_text(v) for k, v in
+                   app_environ(app.split('+'), kvs).items()}
+            fp = join(outdir, artifact.artifact_name(app))
+            if 'kv' in formats:
+                artifact.write(fp + artifact.SUFFIX, env)
+                written.append(fp + artifact.SUFFIX)
+            if 'env' in formats:
+                _write_file(fp + '.env', output.format_env(app, env))
+                written.append(fp + '.env')
+            if 'envdir' in formats:
+                _write_envdir(fp + '.envdir', env)
+                written.append(fp + '.envdir')
+    return written
+
+
+def _write_file(fp, text):
+    """Replace file `fp` with one containing `text`"""
+    tmpfp = '%s.tmp%s' % (fp, os.getpid())
+    with open(tmpfp, 'w') as fout:
+        fout.write(text)
+    os.rename(tmpfp, fp)
+
+
+def _write_envdir(dirpath, env):
+    """Make `dirpath` a directory with one file per key of `env`.
+
+    `dirpath` is a symlink to a versioned directory.  The new version is
+    complete before the symlink is swapped to it with one rename(), so
+    readers see either the old or the new envdir, never a missing one"""
+    parent, name = os.path.split(os.path.abspath(dirpath))
+    umask = os.umask(0)
+    os.umask(umask)
+    version = tempfile.mkdtemp(dir=parent, prefix='%s.v' % name)
+    link = None
+    try:
+        os.chmod(version, 0o777 & ~umask)  # mkdtemp only allows the owner
+        for k, v in env.items():
+            with open(join(version, k), 'w') as fout:
+                fout.write(v)
+        link = '%s.tmp%s' % (version, os.getpid())
+        os.symlink(basename(version), link)
+        previous = None
+        if os.path.islink(dirpath):
+            previous = join(parent, os.readlink(dirpath))
+            os.rename(link, dirpath)
+        elif os.path.isdir(dirpath):
+            # a plain directory, from before envdirs were symlinks.
+            # rename() cannot replace it with a symlink, so move it aside
+            previous = tempfile.mkdtemp(dir=parent, prefix='%s.old' % name)
+            os.rename(dirpath, previous)
+            try:
+                os.rename(link, dirpath)
+            except BaseException:
+                os.rename(previous, dirpath)
+                raise
+        else:
+            os.rename(link, dirpath)
+    except BaseException:
+        if link is not None and os.path.islink(link):
+            os.remove(link)
+        shutil.rmtree(version, ignore_errors=True)
+        raise
+    if previous is not None and previous != version:
+        shutil.rmtree(previous, ignore_errors=True)
+
+
+def compile_main(ns):
+    """Run `consulconf compile`"""
+    configure_logging(ns.log or ns.log_json, json_lines=ns.log_json)
+    _configure_transport(ns)
+    for fp in compile_apps(ns.apps, input_basepath(ns.inputuri), ns.outdir,
+                           formats=ns.formats):
+        print(fp)
+
+
+def _init_parse_worker(prefetched):
+    _PREFETCHED.update(prefetched)
+    _forget_loaded()
+
+
+def _parse_worker(args):
+    """Check and parse one file in a worker process.
+    Return (status, result), where status is 'ok', 'invalid' or 'error'"""
+    jsonfn, basepath, raw = args
+    if not raw:
+        try:
+            resolve_inheritance([jsonfn], basepath)
+        except Exception as err:
+            return ('invalid', err)
+    try:
+        if raw:
+            return ('ok', parse_raw(jsonfn, basepath))
+        return ('ok', list(parse(jsonfn, basepath)))
+    except Exception as err:
+        return ('error', err)
+
+
+def parse_parallel(files, basepath, jobs, raw=False):
+    """Parse files across `jobs` worker processes.  Each worker loads the
+    files that _inherit keypaths point to on its own.
+
+    Results are merged in the same order as the serial path, and errors are
+    raised the same way:  invalid _inherit keypaths in any file before
+    errors found while parsing, and the first file's error first
+    """
+    pool = multiprocessing.Pool(
+        jobs, initializer=_init_parse_worker,
+        initargs=({basepath: _PREFETCHED[basepath]}
+                  if basepath in _PREFETCHED else {}, ))
+    try:
+        results = list(pool.imap(
+            _parse_worker, [(jsonfn, basepath, raw) for jsonfn in files],
+            chunksize=max(1, len(files) // (jobs * 4))))
+        pool.close()
+    except BaseException:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    for bad_status in ('invalid', 'error'):
+        for jsonfn, (status, result) in zip(files, results):
+            if status == bad_status:
+                log.error("Could not parse file", extra=dict(
+                    jsonfn=jsonfn, error=result))
+                raise result
+    kvs = {}
+    for _, result in results:
+        kvs.update(result)
+    return kvs
+
+
+def _cached_apps(ns, basepath):
+    """Resolve the namespaces given to --app, using the snapshots in
+    --cache_dir if they are up to date.  If consul is unreachable, use
+    snapshots no older than --cache_max_stale"""
+    apps = ns.app[0].split('+')
+    try:
+        index = consul_index(basepath)
+    except (APIFail, requests.RequestException) as err:
+        kvs = {name: snapshot.read(
+            ns.cache_dir, basepath, name, max_age=ns.cache_max_stale)
+            for name in apps}
+        missing = [name for name, snap in kvs.items() if snap is None]
+        if missing:
+            log.error(
+                "Consul is unreachable and there is no recent snapshot",
+                extra=dict(namespaces=missing, error=err))
+            raise
+        log.warning("Consul is unreachable.  Using snapshots", extra=dict(
+            namespaces=apps, error=err))
+        return {name: snap['values'] for name, snap in kvs.items()}
+
+    kvs = {}
+    for name in apps:
+        snap = snapshot.read(ns.cache_dir, basepath, name)
+        if snap and snap['index'] == index:
+            log.debug("Snapshot is up to date", extra=dict(namespace=name))
+            snapshot.touch(ns.cache_dir, basepath, name)
+            kvs[name] = snap['values']
+        else:
+            kvs[name] = resolve_namespace(name, basepath)
+            snapshot.write(ns.cache_dir, basepath, name, index, kvs[name])
+    return kvs
 
 
 def process_output(ns, kvs, basepath):
@@ -303,64 +1436,252 @@ def process_output(ns, kvs, basepath):
         env = dict()
         if ns.inherit_env:
             env.update(os.environ)
-        [env.update(kvs[app]) for app in apps]
-        keys = Counter([keys for app in apps for keys in kvs[app]])
-        if any(x > 1 for x in keys.values()):
-            log.warn(
-                'Duplicate keys defined',
-                extra=dict(keys=[k for k, v in keys.items() if v > 1]))
+        if ns.watch:
+            return _watch_app(ns, apps, env, basepath)
+        env = app_environ(apps, kvs, env)
+        if ns.exec_app:
+            return _exec_app(ns, env)
         try:
-            subprocess.check_call(' '.join(ns.app[1:]), shell=True, env=env)
+            with stats.phase('app'):
+                subprocess.check_call(
+                    ' '.join(ns.app[1:]), shell=True, env=env)
         except:
             log.error("Command failed", extra=dict(cmd=' '.join(ns.app[1:])))
             sys.exit(1)
         return
     if ns.filterns:
-        kvs = {k: v for k, v in kvs.items() if re.search(ns.filterns, k)}
+        with stats.phase('filter'):
+            regex = re.compile(ns.filterns)
+            kvs = {k: v for k, v in kvs.items() if regex.search(k)}
 
+    if ns.sync:
+        push_to_targets(ns.puturl, lambda puturl, session: sync_to_consul(
+            kvs, puturl, delete_excludes=ns.delete_excludes,
+            delete_within=own_directories(kvs) if ns.filterns else None,
+            dry_run=ns.dry_run, txn=ns.txn, concurrency=ns.concurrency,
+            session=session))
+        return
     if ns.dry_run:
         print(json.dumps(kvs, indent=4, sort_keys=True))
         return
     elif ns.puturl:
-        if ns.delete:
-            delete_directories(
-                keys=kvs.keys(), delete_excludes=ns.delete_excludes,
-                puturl=ns.puturl)
-        put_to_consul(kvs, ns.puturl)
+        def push(puturl, session):
+            if ns.delete:
+                delete_directories(
+                    keys=kvs.keys(), delete_excludes=ns.delete_excludes,
+                    puturl=puturl, concurrency=ns.concurrency, txn=ns.txn,
+                    session=session, show_plan=True)
+            put_to_consul(
+                kvs, puturl, txn=ns.txn, concurrency=ns.concurrency,
+                session=session)
+        push_to_targets(ns.puturl, push)
     else:
         raise NotImplementedError(
             "Unclear what to do.  You didn't supply an output option")
 
 
+def push_to_targets(puturls, push):
+    """Call push(puturl, session) for each consul url in `puturls`.
+
+    Several targets (ie one per datacenter) are pushed to at the same time,
+    each through its own requests.Session and connection pool, so a slow or
+    failing target does not hold up the others.  When all are done, log
+    each failed target and raise APIFail if any failed.  A single target
+    uses the shared session (session=None)
+    """
+    if not puturls:
+        raise ValueError("No consul url to push to.  Pass --puturl")
+    if len(puturls) == 1:
+        push(puturls[0], None)
+        return
+
+    def _push(puturl):
+        session = transport.new_session()
+        try:
+            push(puturl, session)
+        finally:
+            session.close()
+    errors = util.run_concurrently(_push, puturls, len(puturls))
+    for puturl, err in errors:
+        log.error("Failed to push to consul target", extra=dict(
+            puturl=puturl, error=err))
+    if errors:
+        raise APIFail("%s of %s targets failed.  %s" % (
+            len(errors), len(puturls),
+            '  '.join('%s: %s' % (puturl, err) for puturl, err in errors)))
+
+
+def app_environ(apps, kvs, env=None):
+    """Return the environment of an app made of the namespaces in `apps`,
+    starting from dict `env`.  Later namespaces override earlier ones"""
+    env = dict(env or {})
+    [env.update(kvs[app]) for app in apps]
+    keys = Counter([keys for app in apps for keys in kvs[app]])
+    if any(x > 1 for x in keys.values()):
+        log.warning(
+            'Duplicate keys defined',
+            extra=dict(keys=[k for k, v in keys.items() if v > 1]))
+    return env
+
+
+def _exec_app(ns, env):
+    """Replace the consulconf process with the app's command.  The command's
+    args are passed through as given, without a shell"""
+    argv = ns.app[1:]
+    collector = stats.current()
+    if collector is not None and ns.stats:
+        stats.write(collector.report(), ns.stats)
+    sys.stdout.flush()
+    sys.stderr.flush()
+    try:
+        os.execvpe(argv[0], argv, env)
+    except OSError as err:
+        log.error("Command failed", extra=dict(cmd=argv, error=err))
+        sys.exit(1)
+
+
+def _watch_app(ns, apps, env, basepath):
+    # resolve the app from the same snapshot that the first blocking query
+    # waits on, so a change made meanwhile is not missed
+    prefetch('%s/' % basepath.rstrip('/'))
+    watcher = watch.AppWatcher(
+        apps, resolve=lambda name: resolve_namespace(name, basepath),
+        sources=lambda name: namespace_sources(name, basepath),
+        base_env=env)
+    cmd = ' '.join(ns.app[1:])
+    rc = watch.watch_app(
+        cmd, watcher, poll=lambda wait: poll_changes(basepath, wait),
+        debounce=ns.watch_debounce, sig=ns.watch_signal)
+    if rc:
+        log.error("Command failed", extra=dict(cmd=cmd, returncode=rc))
+        sys.exit(1)
+
+
+def _configure_transport(ns):
+    # keep a connection open for each concurrent request, or the pool
+    # discards the extra connections after every request
+    transport.configure(
+        pool_size=max(ns.pool_size, ns.concurrency), timeout=ns.timeout,
+        retries=ns.retries,
+        consistency=ns.consistency, max_stale=ns.max_stale)
+
+
 def to_url(inpt):
     if not inpt.startswith('http://'):
         return "http://%s" % inpt
     return inpt
 
 
+def to_signal(inpt):
+    """Convert a signal name or number, ie HUP or SIGHUP or 1, to a signal"""
+    if inpt.isdigit():
+        return int(inpt)
+    name = inpt.upper()
+    return getattr(signal, name if name.startswith('SIG') else 'SIG' + name)
+
+
+_input_options = at.group(
+    "\nWhere to get key:value configuration",
+    at.add_argument(
+        '-i', '--inputuri', default=os.environ.get('CONSULCONF_INPUT'),
+        help=(
+            "Where to get key:value configuration.  Can be:"
+            "\n 1) a directory containing json files"
+            "\n 2) a consul url to keys the same config that json files"
+            " would contain.  ie. http://127.0.0.1:8500/v1/kv/conf"),
+        required=not os.environ.get('CONSULCONF_INPUT')),
+)
+
+_consul_options = at.group(
+    "\nHow to talk to consul",
+    at.add_argument(
+        '--pool_size', type=int,
+        default=transport.DEFAULTS['pool_size'], help=(
+            "Max number of connections to keep open to consul.  Raised"
+            " to --concurrency if that is larger")),
+    at.add_argument(
+        '--timeout', type=float, default=transport.DEFAULTS['timeout'],
+        help="Seconds to wait for consul to respond"),
+    at.add_argument(
+        '--retries', type=int, default=transport.DEFAULTS['retries'],
+        help=(
+            "Number of times to retry a failed request to consul."
+            "  Retries back off exponentially")),
+    at.add_argument(
+        '--concurrency', type=int, default=1, help=(
+            "Number of PUT or DELETE requests to send to consul at the"
+            " same time")),
+    at.add_argument(
+        '--consistency', choices=transport.CONSISTENCY_MODES,
+        default=os.environ.get(
+            'CONSULCONF_CONSISTENCY', transport.DEFAULTS['consistency']),
+        help=(
+            "Consistency mode of reads of config from a consul --inputuri."
+            "  'stale' lets any consul server answer, rather than only the"
+            " leader, which spreads the load when many hosts start apps at"
+            " once.  'consistent' makes the leader confirm it is still the"
+            " leader.  Reads of --puturl (ie for --sync or --delete) always"
+            " use consul's default mode")),
+    at.add_argument(
+        '--max_stale', type=float, default=None, help=(
+            "Only useful with --consistency stale.  Max seconds since the"
+            " answering server last heard from the leader.  Staler reads"
+            " are sent again to the leader")),
+)
+
+_log_options = at.group(
+    "\nLogging",
+    at.add_argument(
+        '--log', action='store_true', help="log what I'm doing to stdout"),
+    at.add_argument(
+        '--log_json', action='store_true', help=(
+            "log what I'm doing to stdout as one json object per line")),
+)
+
+_daemon_option = at.add_argument(
+    '--daemon', default=os.environ.get(
+        'CONSULCONF_DAEMON', serve.default_address()),
+    help=(
+        "Where `consulconf serve` listens:  a Unix socket path or"
+        " host:port.  --app asks the daemon for its namespaces if one is"
+        " running, and resolves them itself otherwise.  Pass '' to never"
+        " use a daemon"))
+
 build_arg_parser = at.build_arg_parser([
-    at.group(
-        "\nWhere to get key:value configuration",
-        at.add_argument(
-            '-i', '--inputuri', default=os.environ.get('CONSULCONF_INPUT'),
-            help=(
-                "Where to get key:value configuration.  Can be:"
-                "\n 1) a directory containing json files"
-                "\n 2) a consul url to keys the same config that json files"
-                " would contain.  ie. http://127.0.0.1:8500/v1/kv/conf"),
-            required=not os.environ.get('CONSULCONF_INPUT')),
-    ),
+    _input_options,
     at.group(
         "\nWhere to send key:value configuration",
+        at.add_argument('--dry_run', action='store_true', help=(
+            "Print the resulting flattened k:v namespaces.  If given with"
+            " --sync, print the changes --sync would make instead")),
+        at.add_argument(
+            '--output_format', choices=['json'] + sorted(output.FORMATS),
+            default='json', help=(
+                "How --dry_run prints namespaces.  json prints one sorted"
+                " document once everything is resolved.  ndjson (one"
+                " {namespace: data} object per line) and env (shell"
+                " variable assignments) print each namespace as soon as it"
+                " is resolved")),
+        at.add_argument(
+            '--sort_output', action='store_true', help=(
+                "With --output_format ndjson or env, print namespaces"
+                " sorted by name.  Uses temporary files rather than memory"
+                " to sort large outputs")),
+        at.add_argument(
+            '--sort_buffer', type=int, default=10000, help=(
+                "Max number of namespaces --sort_output keeps in memory")),
         at.mutually_exclusive(
-            at.add_argument('--dry_run', action='store_true', help=(
-                "Print the resulting flattened k:v namespaces")),
             at.add_argument(
-                '-p', '--puturl', type=to_url,
-                default=os.environ.get('CONSUL_HOST', ''),
+                '-p', '--puturl', type=to_url, nargs='+',
+                default=[to_url(x) for x in
+                         os.environ.get('CONSUL_HOST', '').split()],
                 help=(
                     'Put the results of --dry_run into consul by passing an'
                     ' HTTP address to PUT to. ie http://127.0.0.1:8500/v1/kv'
+                    '  Pass several addresses (ie one per datacenter) to'
+                    ' parse the input once and push it to all of them at the'
+                    ' same time.  Defaults to the whitespace separated'
+                    ' addresses in $CONSUL_HOST'
                 )),
             at.add_argument(
                 '-a', '--app', nargs=at.argparse.REMAINDER, help=(
@@ -375,43 +1696,169 @@ build_arg_parser = at.build_arg_parser([
                 )),
 
         )),
-    at.add_argument(
-        '--log', action='store_true', help="log what I'm doing to stdout"),
+    at.group(
+        "\nRestart the app when its configuration changes",
+        at.add_argument(
+            '--watch', action='store_true', help=(
+                "Only useful for --app with a consul --inputuri.  Watch"
+                " consul for changes to the app's namespaces (or the"
+                " namespaces they inherit from), and restart the app when its"
+                " environment changes")),
+        at.add_argument(
+            '--watch_debounce', type=float, default=5, help=(
+                "Seconds to wait for consul data to stop changing before"
+                " restarting the app.  Avoids restarting several times while"
+                " a config push is in progress")),
+        at.add_argument(
+            '--watch_signal', type=to_signal, help=(
+                "Instead of restarting the app, send it this signal, ie HUP")),
+    ),
+    _log_options,
     at.add_argument(
         '--raw', action='store_true', help=(
             "read config data as is from input to output."
             " (ie don't parse values in _inherit or _modify)"
         )),
+    at.mutually_exclusive(
+        at.add_argument(
+            '--delete', action='store_true', help=(
+                "clean the output location of any data before pushing to it."
+                "  This is useful in conjunction with --puturl to ensure a"
+                " clean namespace"
+            )),
+        at.add_argument(
+            '--sync', action='store_true', help=(
+                "Make the data under --puturl match the input by comparing"
+                " it to what is already in consul.  Only new or changed keys"
+                " are written, and keys that no longer exist in the input"
+                " are deleted, except those matching --delete_excludes."
+                "  With --filterns, only keys inside the selected namespaces"
+                " are deleted."
+                "  Prints a summary of the changes.  Use with --dry_run to"
+                " see the summary without changing anything"
+            )),
+    ),
     at.add_argument(
-        '--delete', action='store_true', help=(
-            "clean the output location of any data before pushing to it.  This"
-            " is useful in conjunction with --puturl to ensure a clean"
-            " namespace"
-        )),
+        '--jobs', type=int, default=1, help=(
+            "Number of processes to load and parse json files with")),
+    at.add_argument(
+        '--build_cache', default=os.environ.get('CONSULCONF_BUILD_CACHE'),
+        help=(
+            "Only useful when --inputuri is a directory.  Keep a build cache"
+            " in this file, so that reruns only parse the json files that"
+            " changed and the files that inherit from them")),
     at.add_argument(
         '--delete_excludes', nargs='+', default=[], help=(
-            "If specifying --delete, do not delete the specific namespaces"
-            "under your --puturl that match the given prefix(es). "
-            " ie. "
-            "'--puturl .../a --delete --delete_excludes myapp-ns1 myapp3'"
-            " will delete everything under /a except myapp-ns1* and myapp-ns3*"
-            ". This functionality is limited to searching only the first level"
-            " of namespaces you defined, so be sure to test that it does what"
-            " you expect!"
+            "If specifying --delete or --sync, do not delete the keys"
+            " under your --puturl that start with the given prefix(es),"
+            " at any depth.  ie. "
+            "'--puturl .../a --delete --delete_excludes myapp-ns1 app/ns3'"
+            " will delete the directories of the pushed namespaces under /a"
+            " except keys starting with myapp-ns1 or app/ns3.  --delete"
+            " prints the directories and keys it deletes before deleting"
         )),
+    at.add_argument(
+        '--txn', action='store_true', help=(
+            "When pushing to consul, group the writes into transactions of"
+            " up to %s keys rather than sending one request per key.  Each"
+            " transaction either succeeds or fails as a whole."
+        ) % TXN_MAX_OPS),
+    _consul_options,
     at.add_argument(
         '--filterns', nargs='?', help=(
             'Pass a regular expression that selects only the namespaces you'
             ' care to see.  Applies to --dry_run and --puturl, for instance'
         )),
+    at.group(
+        "\nCache namespaces on disk for fast --app startup",
+        at.add_argument(
+            '--cache_dir', default=os.environ.get('CONSULCONF_CACHE_DIR'),
+            help=(
+                "Only useful for --app with a consul --inputuri.  Keep"
+                " snapshots of resolved namespaces in this directory, and use"
+                " them instead of fetching config while consul's index for"
+                " --inputuri is unchanged")),
+        at.add_argument(
+            '--cache_max_stale', type=float, default=3600, help=(
+                "If consul is unreachable, start the app from snapshots that"
+                " were known to be up to date at most this many seconds ago")),
+    ),
     at.add_argument(
         '--inherit_env', action='store_true', help=(
             "Only useful for --app.  If specified, do not remove the"
             " currently known environment variables available to consulconf"
             " before spinning up a subshell")),
+    at.add_argument(
+        '--exec', dest='exec_app', action='store_true', help=(
+            "Only useful for --app.  Replace the consulconf process with the"
+            " app's command instead of running it in a subshell.  The args"
+            " are passed to the command as given, without a shell, so"
+            " shell syntax like $VAR or pipes is not interpreted.  Signals"
+            " go straight to the app")),
+    _daemon_option,
+    at.add_argument(
+        '--stats', nargs='?', const='-', help=(
+            "Record the wall time of each phase of the run (list, fetch,"
+            " parse, resolve, filter, delete, push), the requests sent to"
+            " consul and load_json cache hits.  Write them as json to this"
+            " file, or to stderr if no file is given")),
 ])
 
 
+build_serve_arg_parser = at.build_arg_parser([
+    _input_options,
+    _daemon_option,
+    at.add_argument(
+        '--refresh_interval', type=float, default=60, help=(
+            "Only useful when --inputuri is a directory.  Seconds between"
+            " re-reading the json files")),
+    at.add_argument(
+        '--poll_wait', type=float, default=300, help=(
+            "Only useful with a consul --inputuri.  Max seconds each"
+            " blocking query waits for consul data to change")),
+    at.add_argument(
+        '--max_age', type=float, default=900, help=(
+            "If the input could not be checked for this many seconds,"
+            " stop serving namespaces, so that `consulconf --app` resolves"
+            " them itself.  Should be well above --poll_wait and"
+            " --refresh_interval")),
+    at.add_argument(
+        '--cache_maxsize', type=int, help=(
+            "Max number of parsed json files to keep in memory between"
+            " refreshes.  By default, keep all of them")),
+    at.add_argument(
+        '--cache_ttl', type=float, help=(
+            "Seconds to keep a parsed json file in memory between"
+            " refreshes.  By default, until it changes")),
+    _log_options,
+    _consul_options,
+], prog='consulconf serve', description=(
+    "Keep the namespaces of --inputuri resolved in memory and serve them"
+    " to `consulconf --app`"))
+
+build_compile_arg_parser = at.build_arg_parser([
+    _input_options,
+    at.add_argument(
+        '-o', '--outdir', required=True, help=(
+            "Directory to write the compiled artifacts to")),
+    at.add_argument(
+        '--apps', nargs='+', help=(
+            "The apps to compile, as given to --app.  You can use the +"
+            " operator to combine namespaces, ie ns1+test/app20.  By"
+            " default, compile every namespace")),
+    at.add_argument(
+        '--formats', nargs='+', choices=ARTIFACT_FORMATS,
+        default=list(ARTIFACT_FORMATS), help=(
+            "kv: a sorted binary file.  Start an app from it with"
+            " `python -m consulconf.artifact APP.kv CMD ...`"
+            "  env: a .env file.  envdir: a directory for envdir(8)")),
+    _log_options,
+    _consul_options,
+], prog='consulconf compile', description=(
+    "Resolve apps' namespaces once, ahead of time, and write each app's"
+    " environment to files that start the app without consulconf"))
+
+
 if __name__ == '__main__':
     NS = build_arg_parser().parse_args()
     main(NS)
@@ -0,0 +1,101 @@
+"""
+Write namespaces (or raw keys) as they are resolved, instead of building all
+of them in memory and printing one big json document at the end
+
+    consulconf -i ./json_files --dry_run --output_format ndjson
+    consulconf -i ./json_files --dry_run --output_format env --sort_output
+
+Each item is a (name, value) pair, where value is a namespace's dict of
+key:value data, or the string value of a key when reading --raw.
+"""
+import heapq
+import json
+import os
+import tempfile
+try:
+    from shlex import quote
+except ImportError:  # python 2
+    from pipes import quote
+
+
+def format_ndjson(name, value):
+    """One json object per line.  Merging the objects gives the same dict
+    that --output_format json prints"""
+    return '%s\n' % json.dumps({name: value}, sort_keys=True)
+
+
+def _shell_value(value):
+    """Quote any value, not only strings, for a shell"""
+    return quote('%s' % (value,))
+
+
+def format_env(name, value):
+    """Lines a shell can source.  Each namespace starts with a comment.
+    Raw keys, such as ns/key, are not valid variable names, so --raw data
+    is not written as env"""
+    return '# %s\n%s' % (name, ''.join(
+        '%s=%s\n' % (k, _shell_value(value[k])) for k in sorted(value)))
+
+
+FORMATS = dict(ndjson=format_ndjson, env=format_env)
+
+
+def _spill(chunk):
+    """Sort a chunk of (name, text) pairs and save it to a temporary file.
+    Return the file path"""
+    fd, fp = tempfile.mkstemp(prefix='consulconf-sort-')
+    with os.fdopen(fd, 'w') as fout:
+        for item in sorted(chunk):
+            fout.write('%s\n' % json.dumps(item))
+    return fp
+
+
+def _read_spilled(fp):
+    with open(fp) as fin:
+        for line in fin:
+            yield tuple(json.loads(line))
+
+
+def sort_bounded(items, buffer_size=10000):
+    """Yield (name, text) pairs sorted by name, keeping at most
+    `buffer_size` pairs in memory.  Larger inputs are sorted in chunks that
+    are written to temporary files and merged"""
+    chunk = []
+    spilled = []
+    try:
+        for item in items:
+            chunk.append(item)
+            if len(chunk) >= buffer_size:
+                spilled.append(_spill(chunk))
+                chunk = []
+        if not spilled:
+            for item in sorted(chunk):
+                yield item
+            return
+        if chunk:
+            spilled.append(_spill(chunk))
+            chunk = []
+        for item in heapq.merge(*[_read_spilled(fp) for fp in spilled]):
+            yield item
+    finally:
+        for fp in spilled:
+            os.remove(fp)
+
+
+def write_stream(items, fmt, out, sort=False, buffer_size=10000):
+    """Format and write each (name, value) pair in `items` to file object
+    `out` as soon as it is available.  Return the number of items written
+
+    `fmt` a key of FORMATS
+    `sort` if True, write the items sorted by name, using bounded memory
+    """
+    formatter = FORMATS[fmt]
+    texts = ((name, formatter(name, value)) for name, value in items)
+    if sort:
+        texts = sort_bounded(texts, buffer_size)
+    n = 0
+    for _, text in texts:
+        out.write(text)
+        n += 1
+    out.flush()
+    return n
@@ -0,0 +1,277 @@
+"""
+Keep resolved namespaces in memory and serve them to `consulconf --app`, so
+that apps starting on a busy host do not each fetch and parse the config
+
+    consulconf serve -i http://127.0.0.1:8500/v1/kv/conf
+    consulconf -i http://127.0.0.1:8500/v1/kv/conf --app ns1 env
+
+The daemon listens on a Unix socket (or localhost HTTP) and answers:
+    GET /v1/namespaces?basepath=...&ns=ns1&ns=test/app20
+        {"namespaces": {"ns1": {...}, "test/app20": {...}}}
+        or 503 if the namespaces are stale (see `consulconf serve --max_age`)
+    GET /v1/status
+"""
+import json
+import os
+import signal
+import socket
+import sys
+import tempfile
+import threading
+import time
+try:
+    from http.client import HTTPConnection, HTTPException
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import TCPServer, ThreadingMixIn
+    from urllib.parse import parse_qs, urlencode, urlparse
+except ImportError:  # python 2
+    from httplib import HTTPConnection, HTTPException
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import TCPServer, ThreadingMixIn
+    from urllib import urlencode
+    from urlparse import parse_qs, urlparse
+
+from consulconf import log
+
+
+def default_address():
+    """The Unix socket that the daemon and --app use by default"""
+    return os.path.join(
+        tempfile.gettempdir(), 'consulconf-%s.sock' % os.getuid())
+
+
+def _split_address(address):
+    """Return (path of a Unix socket, None) or (host, port)"""
+    if address.startswith('http://'):
+        address = address[len('http://'):].rstrip('/')
+    elif not address.startswith(('unix://', '/', '.')):
+        host, _, port = address.rpartition(':')
+        if port.isdigit():
+            return host or '127.0.0.1', int(port)
+    return address.replace('unix://', '', 1), None
+
+
+class Daemon(object):
+    """Hold the namespaces resolved from `basepath` in memory and keep them
+    up to date.
+
+    `load()` return {name: key:value data} of all namespaces
+    `poll(wait)` wait up to `wait` seconds for the input to change, and
+        return the set of files that changed.  If None, reload the input
+        every `interval` seconds instead
+    `max_age` seconds after the input was last checked successfully that
+        the namespaces are considered stale and no longer served.  None to
+        serve them however old they are
+    """
+    def __init__(self, basepath, load, poll=None, interval=60,
+                 max_age=None):
+        self.basepath = basepath
+        self.load = load
+        self.poll = poll
+        self.interval = interval
+        self.max_age = max_age
+        self.version = 0
+        self.refresh()
+
+    def refresh(self):
+        namespaces = self.load()
+        self.namespaces = namespaces  # readers see the old or the new dict
+        self.version += 1
+        self.refreshed = self.checked = time.time()
+        log.info("Loaded namespaces", extra=dict(
+            basepath=self.basepath, count=len(namespaces),
+            version=self.version))
+
+    def stale(self):
+        """Return True if the input has not been checked for too long, ie
+        because refreshing keeps failing"""
+        return self.max_age is not None and \
+            time.time() - self.checked > self.max_age
+
+    def lookup(self, names):
+        """Return ({name: key:value data}, list of unknown names)"""
+        namespaces = self.namespaces
+        return ({name: namespaces[name] for name in names
+                 if name in namespaces},
+                [name for name in names if name not in namespaces])
+
+    def status(self):
+        return dict(
+            basepath=self.basepath, version=self.version,
+            refreshed=self.refreshed, checked=self.checked,
+            stale=self.stale(), namespaces=len(self.namespaces))
+
+    def refresh_forever(self, stop, wait=300):
+        """Reload the namespaces whenever the input changes, until `stop`
+        is set.  Keep serving the last good namespaces if reloading fails,
+        until they are older than `max_age`"""
+        failures = 0
+        while not stop.is_set():
+            try:
+                if self.poll is None:
+                    stop.wait(self.interval)
+                    changed = not stop.is_set()
+                else:
+                    changed = self.poll(wait)
+                if changed:
+                    self.refresh()
+                else:
+                    self.checked = time.time()
+            except Exception as err:
+                failures += 1
+                delay = min(2 ** failures, 60)
+                log.error("Could not refresh namespaces", extra=dict(
+                    error=err, retry_in_seconds=delay))
+                stop.wait(delay)
+                continue
+            failures = 0
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        daemon = self.server.daemon
+        url = urlparse(self.path)
+        params = parse_qs(url.query)
+        if url.path == '/v1/status':
+            return self._reply(200, daemon.status())
+        if url.path != '/v1/namespaces':
+            return self._reply(404, dict(error="Unknown path"))
+        if params.get('basepath', [daemon.basepath])[0] != daemon.basepath:
+            return self._reply(409, dict(
+                error="Serving another input", basepath=daemon.basepath))
+        if daemon.stale():
+            return self._reply(503, dict(
+                error="Namespaces are stale", checked=daemon.checked))
+        namespaces, missing = daemon.lookup(params.get('ns', []))
+        if missing:
+            return self._reply(404, dict(
+                error="Unrecognized namespaces", missing=missing))
+        return self._reply(200, dict(
+            namespaces=namespaces, version=daemon.version))
+
+    def _reply(self, status, data):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, fmt, *args):
+        log.debug("Served request", extra=dict(request=fmt % args))
+
+
+class _TCPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _UnixServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    address_family = socket.AF_UNIX
+
+    def server_bind(self):
+        TCPServer.server_bind(self)  # skip HTTPServer's hostname lookup
+        self.server_name, self.server_port = 'localhost', 0
+
+
+def make_server(daemon, address):
+    """Return an HTTP server for `daemon` listening on `address`:  a Unix
+    socket path, or host:port"""
+    host, port = _split_address(address)
+    if port is not None:
+        server = _TCPServer((host, port), _Handler)
+    else:
+        if os.path.exists(host):
+            if _reachable(host):
+                raise RuntimeError(
+                    "A consulconf daemon already listens on %s" % host)
+            os.remove(host)  # left behind by a daemon that died
+        old_umask = os.umask(0o177)
+        try:
+            server = _UnixServer(host, _Handler)
+        finally:
+            os.umask(old_umask)
+    server.daemon = daemon
+    return server
+
+
+def serve_forever(daemon, address, wait=300):
+    """Serve the daemon's namespaces on `address` and refresh them in a
+    background thread until interrupted"""
+    server = make_server(daemon, address)
+    stop = threading.Event()
+    refresher = threading.Thread(
+        target=daemon.refresh_forever, args=(stop, wait))
+    refresher.daemon = True
+    refresher.start()
+    log.info("Serving namespaces", extra=dict(
+        address=address, basepath=daemon.basepath))
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop.set()
+        server.server_close()
+        if _split_address(address)[1] is None:
+            os.remove(_split_address(address)[0])
+
+
+class _UnixConnection(HTTPConnection):
+    def __init__(self, path, timeout):
+        HTTPConnection.__init__(self, 'localhost', timeout=timeout)
+        self.socket_path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+def _reachable(path):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+        return True
+    except socket.error:
+        return False
+    finally:
+        sock.close()
+
+
+def lookup(address, basepath, names, timeout=2):
+    """Ask the daemon at `address` for namespaces resolved from `basepath`.
+    Return {name: key:value data}, or None if no daemon is available or it
+    cannot answer, in which case the caller should resolve them itself"""
+    host, port = _split_address(address)
+    if port is None:
+        try:
+            owner = os.stat(host).st_uid
+        except OSError:
+            return None  # no daemon running
+        if owner not in (0, os.getuid()):
+            log.warning("Ignoring a daemon socket owned by another user",
+                        extra=dict(address=address, uid=owner))
+            return None
+        conn = _UnixConnection(host, timeout)
+    else:
+        conn = HTTPConnection(host, port, timeout=timeout)
+    query = urlencode([('basepath', basepath)] + [('ns', n) for n in names])
+    try:
+        conn.request('GET', '/v1/namespaces?%s' % query)
+        resp = conn.getresponse()
+        body = json.loads(resp.read().decode('utf-8'))
+    except (socket.error, HTTPException, ValueError) as err:
+        log.info("Could not reach the consulconf daemon", extra=dict(
+            address=address, error=err))
+        return None
+    finally:
+        conn.close()
+    if resp.status != 200:
+        log.info("The consulconf daemon could not answer", extra=dict(
+            address=address, status=resp.status, error=body.get('error')))
+        return None
+    log.debug("Got namespaces from the consulconf daemon", extra=dict(
+        address=address, namespaces=names))
+    return body['namespaces']
@@ -0,0 +1,58 @@
+"""
+An on-disk cache of resolved namespaces, so that --app can start without
+fetching and parsing config from consul when nothing changed.
+
+Each snapshot is a json file that records the X-Consul-Index its namespace
+was resolved at.  A snapshot's modification time is the last time it was
+known to be up to date.
+"""
+import hashlib
+import json
+import os
+from os.path import join
+import time
+
+from consulconf import log, util
+
+
+def snapshot_path(cache_dir, basepath, name):
+    key = ('%s\0%s' % (basepath, name)).encode('utf-8')
+    return join(cache_dir, '%s.json' % hashlib.sha1(key).hexdigest())
+
+
+def read(cache_dir, basepath, name, max_age=None):
+    """Return the snapshot of namespace `name` as a dict with keys
+    "index" and "values", or None if there is no usable snapshot.
+
+    `max_age` if given, ignore snapshots last validated longer ago than this
+        many seconds
+    """
+    fp = snapshot_path(cache_dir, basepath, name)
+    try:
+        age = time.time() - os.path.getmtime(fp)
+        if max_age is not None and age > max_age:
+            log.debug("Snapshot is too old", extra=dict(fp=fp, namespace=name))
+            return None
+        with open(fp) as fin:
+            snapshot = json.load(fin)
+    except (IOError, OSError, ValueError):
+        return None
+    if snapshot.get('basepath') != basepath or snapshot.get('name') != name:
+        return None
+    return snapshot
+
+
+def touch(cache_dir, basepath, name):
+    """Mark a snapshot as up to date as of now"""
+    try:
+        os.utime(snapshot_path(cache_dir, basepath, name), None)
+    except OSError:
+        pass
+
+
+def write(cache_dir, basepath, name, index, values):
+    """Atomically save a snapshot of namespace `name`.  Concurrent readers
+    see either the previous snapshot or this one, never a partial file"""
+    util.atomic_write_json(
+        snapshot_path(cache_dir, basepath, name),
+        dict(basepath=basepath, name=name, index=index, values=values))
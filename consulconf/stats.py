@@ -0,0 +1,139 @@
+"""
+Record where a consulconf run spends its time:  wall time per phase, HTTP
+requests to consul and load_json cache hits  (ie.  consulconf --stats)
+
+    from consulconf import stats
+    with stats.collect() as collector:
+        consulconf.main.main(ns)
+    print(collector.report())
+
+Phases nest.  The time of a phase excludes the time of the phases inside it,
+so the phase times of a run add up to (at most) its wall time.
+When nothing is collecting, phase() does nothing.
+"""
+from collections import Counter
+from contextlib import contextmanager
+import json
+import sys
+import threading
+import time
+
+from consulconf import transport
+
+_collector = None
+_local = threading.local()
+
+
+class Collector(object):
+    """Accumulate phase times and HTTP responses.
+
+    `cache` optional object with a stats() method (ie a TreeCache) whose
+        counters are reported as their change since the collector started
+    """
+    def __init__(self, cache=None):
+        self.cache = cache
+        self.phases = {}
+        self.responses = []  # (method, status, seconds, sent, received)
+        self._lock = threading.Lock()
+        self.start = time.time()
+        self.end = None
+        self._cache_start = cache.stats() if cache is not None else None
+
+    def add_phase(self, name, seconds):
+        with self._lock:
+            self.phases[name] = self.phases.get(name, 0) + seconds
+
+    def record_response(self, resp, *args, **kwargs):
+        """A requests response hook"""
+        body = resp.request.body
+        sent = len(body) if body else 0
+        with self._lock:
+            self.responses.append((
+                resp.request.method, resp.status_code,
+                resp.elapsed.total_seconds(), sent, len(resp.content or b'')))
+
+    def report(self):
+        """Return the statistics as a dict"""
+        with self._lock:
+            responses = list(self.responses)
+            phases = dict(self.phases)
+        latencies = sorted(r[2] for r in responses)
+        rv = dict(
+            wall_seconds=(self.end or time.time()) - self.start,
+            phases=phases,
+            http=dict(
+                requests=len(responses),
+                methods=dict(Counter(r[0] for r in responses)),
+                errors=sum(1 for r in responses if r[1] >= 400),
+                bytes_sent=sum(r[3] for r in responses),
+                bytes_received=sum(r[4] for r in responses),
+                latency_seconds={
+                    name: percentile(latencies, pct) for name, pct in [
+                        ('p50', 50), ('p90', 90), ('p99', 99), ('max', 100)]},
+            ))
+        if self.cache is not None:
+            now = self.cache.stats()
+            rv['cache'] = {
+                k: now[k] - self._cache_start[k] for k in (
+                    'hits', 'misses', 'negative_hits', 'evictions',
+                    'expirations')}
+        return rv
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of sorted `values`, or None if empty"""
+    if not values:
+        return None
+    rank = int(round(pct / 100. * (len(values) - 1)))
+    return values[rank]
+
+
+@contextmanager
+def collect(cache=None):
+    """Record statistics while the block runs.  Yield the Collector"""
+    global _collector
+    collector = Collector(cache)
+    previous, _collector = _collector, collector
+    transport.add_response_hook(collector.record_response)
+    try:
+        yield collector
+    finally:
+        transport.remove_response_hook(collector.record_response)
+        _collector = previous
+        collector.end = time.time()
+
+
+def current():
+    """Return the Collector that is recording, or None"""
+    return _collector
+
+
+@contextmanager
+def phase(name):
+    """Attribute the time spent in this block to phase `name`"""
+    collector = _collector
+    if collector is None:
+        yield
+        return
+    stack = getattr(_local, 'stack', None)
+    if stack is None:
+        stack = _local.stack = []
+    stack.append(0)  # time spent in nested phases
+    start = time.time()
+    try:
+        yield
+    finally:
+        elapsed = time.time() - start
+        collector.add_phase(name, elapsed - stack.pop())
+        if stack:
+            stack[-1] += elapsed
+
+
+def write(report, fp):
+    """Write a report as json to file path `fp`, or to stderr if fp is '-'"""
+    out = json.dumps(report, indent=4, sort_keys=True)
+    if fp == '-':
+        sys.stderr.write('%s\n' % out)
+    else:
+        with open(fp, 'w') as fout:
+            fout.write(out)
@@ -0,0 +1,191 @@
+"""
+An in-memory stand-in for the Consul key:value HTTP api, for tests and
+benchmarks.  Install it as the transport for all Consul traffic:
+
+    from consulconf import transport
+    from consulconf.testing import FakeConsul
+    consul = FakeConsul()
+    transport.configure(adapter=consul)
+    ...
+    transport.reset()
+"""
+import base64
+import json
+import re
+import threading
+import time
+
+import requests
+from requests.adapters import BaseAdapter
+from requests.structures import CaseInsensitiveDict
+try:
+    from urllib.parse import urlsplit, parse_qs, unquote
+except ImportError:  # python 2
+    from urlparse import urlsplit, parse_qs
+    from urllib import unquote
+
+
+class FakeConsul(BaseAdapter):
+    """Serve the subset of Consul's HTTP api that consulconf uses:
+    GET/PUT/DELETE on /v1/kv/... and PUT on /v1/txn.  Urls outside of /v1/
+    (ie a --puturl of http://host/) are treated as keys too
+
+    `data` optional dict of {key: value} to start with
+    `txn_max_ops` reject transactions with more operations than this
+
+    Attributes useful to tests:
+    `requests` a list of (method, url) for each request received
+    `fail` None, or a function that receives each requests.PreparedRequest
+        and returns an HTTP status code to fail the request with (or None)
+    `last_contact` milliseconds since the answering server last heard from
+        the leader, reported as X-Consul-LastContact to ?stale reads
+    """
+    def __init__(self, data=None, txn_max_ops=64):
+        super(FakeConsul, self).__init__()
+        self.kv = {}  # key: (value as bytes or None, modify index)
+        self.index = 0
+        self.txn_max_ops = txn_max_ops
+        self.requests = []
+        self.fail = None
+        self.last_contact = 0
+        self._lock = threading.RLock()
+        self._changed = threading.Condition(self._lock)
+        for k, v in (data or {}).items():
+            self.set(k, v)
+
+    def set(self, key, value):
+        if value is not None and not isinstance(value, bytes):
+            value = value.encode('utf-8')
+        with self._lock:
+            self.index += 1
+            self.kv[key] = (value or None, self.index)
+            self._changed.notify_all()
+
+    def get(self, key):
+        value = self.kv[key][0]
+        return value.decode('utf-8') if value is not None else None
+
+    def delete(self, key, recurse=False):
+        with self._lock:
+            keys = self._prefixed(key) if recurse else [key]
+            for k in keys:
+                self.kv.pop(k, None)
+            self.index += 1
+            self._changed.notify_all()
+
+    def close(self):
+        pass
+
+    def _prefixed(self, prefix):
+        return sorted(k for k in self.kv if k.startswith(prefix))
+
+    def _response(self, request, status, content=b'', headers=None):
+        resp = requests.Response()
+        resp.status_code = status
+        resp._content = content
+        resp.encoding = 'utf-8'
+        resp.headers = CaseInsensitiveDict(headers or {})
+        resp.headers.setdefault('X-Consul-Index', str(self.index))
+        resp.headers.setdefault('X-Consul-KnownLeader', 'true')
+        resp.headers.setdefault('X-Consul-LastContact', '0')
+        resp.request = request
+        resp.url = request.url
+        return resp
+
+    def _json(self, request, data, status=200):
+        return self._response(
+            request, status, json.dumps(data).encode('utf-8'),
+            {'Content-Type': 'application/json'})
+
+    def _entry(self, key):
+        value, index = self.kv[key]
+        return {
+            'Key': key, 'CreateIndex': index, 'ModifyIndex': index,
+            'LockIndex': 0, 'Flags': 0,
+            'Value': (base64.b64encode(value).decode('ascii')
+                      if value is not None else None)}
+
+    def send(self, request, stream=False, timeout=None, verify=True,
+             cert=None, proxies=None):
+        self.requests.append((request.method, request.url))
+        status = self.fail(request) if self.fail else None
+        if status:
+            return self._response(request, status, b'injected failure')
+        url = urlsplit(request.url)
+        path = unquote(url.path)
+        params = parse_qs(url.query, keep_blank_values=True)
+        body = request.body
+        if body is not None and not isinstance(body, bytes):
+            body = body.encode('utf-8')
+
+        with self._lock:
+            if path == '/v1/txn' and request.method == 'PUT':
+                return self._txn(request, body)
+            if path.startswith('/v1/kv'):
+                key = path[len('/v1/kv'):].lstrip('/')
+            elif not path.startswith('/v1/'):
+                key = path.lstrip('/')  # a bare url, ie http://host/key
+            else:
+                return self._response(request, 404)
+            if request.method == 'GET':
+                return self._kv_get(request, key, params)
+            if request.method == 'PUT':
+                self.set(key, body)
+                return self._json(request, True)
+            if request.method == 'DELETE':
+                self.delete(key, recurse='recurse' in params)
+                return self._json(request, True)
+        return self._response(request, 405)
+
+    def _block(self, params):
+        """Wait for a change, like a consul blocking query"""
+        if 'index' not in params:
+            return
+        index = int(params['index'][0])
+        wait = params.get('wait', ['5m'])[0]
+        num, unit = re.match(r'^(\d+)(ms|s|m)?$', wait).groups()
+        deadline = time.time() + (
+            int(num) * {'ms': .001, 's': 1, 'm': 60}[unit or 's'])
+        while self.index <= index and time.time() < deadline:
+            self._changed.wait(deadline - time.time())
+
+    def _kv_get(self, request, key, params):
+        self._block(params)
+        if 'keys' in params:
+            sep = params.get('separator', [''])[0]
+            keys = []
+            for k in self._prefixed(key):
+                if sep and sep in k[len(key):]:
+                    k = k[:k.index(sep, len(key)) + len(sep)]
+                if not keys or keys[-1] != k:
+                    keys.append(k)
+            data = keys
+        elif 'recurse' in params:
+            data = [self._entry(k) for k in self._prefixed(key)]
+        else:
+            data = [self._entry(key)] if key in self.kv else []
+        if not data:
+            resp = self._response(request, 404)
+        else:
+            resp = self._json(request, data)
+        if 'stale' in params:
+            resp.headers['X-Consul-LastContact'] = str(self.last_contact)
+        return resp
+
+    def _txn(self, request, body):
+        ops = json.loads(body.decode('utf-8'))
+        if len(ops) > self.txn_max_ops:
+            return self._response(
+                request, 413, b'Transaction contains too many operations')
+        for op in ops:
+            if op['KV']['Verb'] not in ('set', 'delete', 'delete-tree'):
+                return self._json(request, {'Results': None, 'Errors': [
+                    {'OpIndex': ops.index(op),
+                     'What': 'unsupported verb'}]}, status=409)
+        for op in ops:
+            op = op['KV']
+            if op['Verb'] == 'set':
+                self.set(op['Key'], base64.b64decode(op.get('Value') or ''))
+            else:
+                self.delete(op['Key'], recurse=op['Verb'] == 'delete-tree')
+        return self._json(request, {'Results': [], 'Errors': None})
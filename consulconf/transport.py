@@ -0,0 +1,168 @@
+"""
+All HTTP traffic to Consul goes through one shared, pooled requests.Session
+
+    from consulconf import transport
+    transport.configure(pool_size=20, timeout=5, retries=5)
+    transport.get('http://127.0.0.1:8500/v1/kv/a', params={'recurse': True})
+
+Reads of config data can use consul's stale or consistent modes.  Stale
+reads can be answered by any consul server, which spreads the load of many
+readers across the cluster.  Only read() applies the mode.  get() always
+uses consul's default mode:
+    transport.configure(consistency='stale', max_stale=10)
+    transport.read('http://127.0.0.1:8500/v1/kv/a', params={'recurse': True})
+
+Pass `adapter` to send requests somewhere other than the network, ie:
+    transport.configure(adapter=consulconf.testing.FakeConsul())
+"""
+import threading
+
+import requests
+
+from consulconf import log
+from requests.adapters import HTTPAdapter
+try:
+    from urllib3.util.retry import Retry
+except ImportError:
+    from requests.packages.urllib3.util.retry import Retry
+
+
+DEFAULTS = dict(pool_size=10, timeout=30, retries=3, backoff=0.1,
+                consistency='default', max_stale=None)
+CONSISTENCY_MODES = ('default', 'stale', 'consistent')
+
+_options = dict(DEFAULTS, adapter=None)
+_session = None
+_response_hooks = []
+_lock = threading.Lock()
+
+
+def configure(**options):
+    """Change the options used to talk to Consul.  Options not given are
+    left as they are.  The shared session is rebuilt on next use.
+
+    `pool_size` max number of connections kept alive per consul host
+    `timeout` seconds to wait for a connection or a response
+    `retries` number of times to retry connection errors and 5xx responses
+    `backoff` backoff factor (seconds) between retries.  Wait time grows
+        exponentially: backoff * 2^(retry number)
+    `adapter` a requests adapter (ie consulconf.testing.FakeConsul) that
+        receives all requests instead of the network.  None to use the network
+    `consistency` consul's consistency mode for read():  "default",
+        "stale" (any server may answer) or "consistent" (the leader checks
+        that it is still the leader before answering)
+    `max_stale` only for "stale" reads.  If the server that answered last
+        heard from the leader more than this many seconds ago, send the read
+        again in default mode, so the leader answers it.  None for no limit
+    """
+    global _session
+    unknown = set(options).difference(_options)
+    if unknown:
+        raise TypeError("Unrecognized options: %s" % ', '.join(unknown))
+    if options.get('consistency', 'default') not in CONSISTENCY_MODES:
+        raise ValueError(
+            "Unrecognized consistency mode: %s" % options['consistency'])
+    with _lock:
+        _options.update(options)
+        if _session is not None:
+            _session.close()
+        _session = None
+
+
+def reset():
+    """Restore the default options and send requests to the network"""
+    configure(adapter=None, **DEFAULTS)
+
+
+def add_response_hook(hook):
+    """Call hook(response) for every response from Consul.
+    ie consulconf.stats uses this to count requests"""
+    _response_hooks.append(hook)
+
+
+def remove_response_hook(hook):
+    _response_hooks.remove(hook)
+
+
+def _retry():
+    kwargs = dict(
+        total=_options['retries'], backoff_factor=_options['backoff'],
+        status_forcelist=(500, 502, 503, 504), raise_on_status=False)
+    try:  # consul PUTs and DELETEs are idempotent.  retry all methods
+        return Retry(allowed_methods=None, **kwargs)
+    except TypeError:  # urllib3 < 1.26
+        return Retry(method_whitelist=False, **kwargs)
+
+
+def new_session():
+    """Return a new requests.Session, with its own connection pool, that is
+    configured with the current options"""
+    session = requests.Session()
+    adapter = _options['adapter'] or HTTPAdapter(
+        pool_connections=_options['pool_size'],
+        pool_maxsize=_options['pool_size'],
+        max_retries=_retry())
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def get_session():
+    """Return the session shared by all Consul requests"""
+    global _session
+    with _lock:
+        if _session is None:
+            _session = new_session()
+        return _session
+
+
+def request(method, url, session=None, **kwargs):
+    """Like requests.request, but send it through the shared session (or the
+    given `session`) and apply the configured timeout"""
+    kwargs.setdefault('timeout', _options['timeout'])
+    if _response_hooks:
+        kwargs.setdefault('hooks', {'response': list(_response_hooks)})
+    return (session or get_session()).request(method, url, **kwargs)
+
+
+def get(url, **kwargs):
+    return request('GET', url, **kwargs)
+
+
+def read(url, **kwargs):
+    """GET config data from consul in the configured consistency mode"""
+    mode = _options['consistency']
+    if mode == 'default':
+        return request('GET', url, **kwargs)
+    params = dict(kwargs.pop('params', None) or {})
+    params[mode] = True
+    resp = request('GET', url, params=params, **kwargs)
+    if mode == 'stale' and _too_stale(resp):
+        log.info("Stale read is too old.  Reading from the leader", extra=dict(
+            url=url, last_contact_ms=resp.headers.get('X-Consul-LastContact'),
+            known_leader=resp.headers.get('X-Consul-KnownLeader')))
+        del params['stale']
+        resp = request('GET', url, params=params, **kwargs)
+    return resp
+
+
+def _too_stale(resp):
+    """Was a stale read answered by a server that has lost the leader, or
+    that last heard from it more than max_stale seconds ago?"""
+    if resp.headers.get('X-Consul-KnownLeader') == 'false':
+        return True
+    if _options['max_stale'] is None:
+        return False
+    try:
+        last_contact = int(resp.headers.get('X-Consul-LastContact', 0))
+    except ValueError:
+        return False
+    return last_contact > _options['max_stale'] * 1000
+
+
+def put(url, **kwargs):
+    return request('PUT', url, **kwargs)
+
+
+def delete(url, **kwargs):
+    return request('DELETE', url, **kwargs)
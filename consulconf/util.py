@@ -1,28 +1,66 @@
-from functools import wraps
+import json
+import os
+import tempfile
+import threading
+try:
+    import queue
+except ImportError:  # python 2
+    import Queue as queue
 
-try:  # py3k only
-    from functools import lru_cache as _lru_cache
 
-    def cached(func):
-        """Wraps functools.lru_cache with maxsize=None"""
-        return _lru_cache(None)(func)
+def run_concurrently(func, items, concurrency):
+    """Call func(item) for each item in `items` using `concurrency` threads.
+    `items` is consumed lazily, so at most `concurrency` calls are in flight
+    (or waiting for a free thread) at any time.
 
-except:  # otherwise, hack this in.
+    Return a list of (item, exception) for the calls that raised an
+    exception, in the same order as `items`.
+    """
+    todo = queue.Queue(maxsize=concurrency)
+    errors = {}
 
-    def cached(func):
-        """Python 2 fake lru_cache.  Ignore `maxsize` and `typed`.
-        This won't work in many scenarios, so don't port this to other projects
+    def worker():
+        while True:
+            task = todo.get()
+            if task is None:
+                return
+            n, item = task
+            try:
+                func(item)
+            except Exception as err:
+                errors[n] = (item, err)
 
-        Assume kwargs are never used
-        """
-        cache_dct = {}
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    try:
+        for task in enumerate(items):
+            todo.put(task)
+    finally:
+        for _ in threads:
+            todo.put(None)
+        for t in threads:
+            t.join()
+    return [errors[n] for n in sorted(errors)]
 
-        @wraps(func)
-        def _lru_cache_decorator(*args):
-            key = args
-            if key in cache_dct:
-                return cache_dct[key]
-            else:
-                cache_dct[key] = func(*args)
-                return cache_dct[key]
-        return _lru_cache_decorator
+
+def atomic_write_json(fp, data):
+    """Write `data` as json to file path `fp`.  Readers see either the
+    previous file or the complete new one, never a partial file"""
+    dirpath = os.path.dirname(os.path.abspath(fp))
+    if not os.path.isdir(dirpath):
+        try:
+            os.makedirs(dirpath)
+        except OSError:  # another process created it first
+            pass
+    fd, tmpfp = tempfile.mkstemp(dir=dirpath, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as fout:
+            json.dump(data, fout)
+            fout.flush()
+            os.fsync(fout.fileno())
+        os.rename(tmpfp, fp)
+    except BaseException:
+        os.remove(tmpfp)
+        raise
@@ -0,0 +1,154 @@
+"""
+Run an app with its namespaces from consul, and restart it whenever those
+namespaces change  (ie.  consulconf --app ... --watch)
+"""
+import os
+import signal
+import subprocess
+import threading
+import time
+try:
+    import queue
+except ImportError:  # python 2
+    import Queue as queue
+
+from consulconf import log
+
+
+def _poll_forever(poll, wait, changes, stop):
+    """Long-poll consul for changes and put the set of changed files on the
+    `changes` queue until `stop` is set.  Back off if consul is unreachable"""
+    failures = 0
+    while not stop.is_set():
+        try:
+            changed = poll(wait)
+        except Exception as err:
+            failures += 1
+            delay = min(2 ** failures, 60)
+            log.error("Could not watch consul for changes", extra=dict(
+                error=err, retry_in_seconds=delay))
+            stop.wait(delay)
+            continue
+        failures = 0
+        if changed:
+            log.info("Consul data changed", extra=dict(files=sorted(changed)))
+            changes.put(changed)
+
+
+class AppWatcher(object):
+    """Keep track of the environment defined by a set of namespaces, and
+    re-resolve only the namespaces affected by a change.
+
+    `namespaces` list of namespace names, ie ['ns1', 'test/app20']
+    `resolve(name)` return the key:value data of a namespace
+    `sources(name)` return the set of files a namespace gets its data from
+    `base_env` environment to start from, before adding the namespaces
+    """
+    def __init__(self, namespaces, resolve, sources, base_env=None):
+        self.namespaces = namespaces
+        self.resolve = resolve
+        self.sources = sources
+        self.base_env = dict(base_env or {})
+        self.values = {name: resolve(name) for name in namespaces}
+
+    @property
+    def env(self):
+        env = dict(self.base_env)
+        for name in self.namespaces:
+            env.update(self.values[name])
+        return env
+
+    def refresh(self, changed_files):
+        """Re-resolve the namespaces that read from any of the changed files.
+        Return True if the environment changed"""
+        affected = [
+            name for name in self.namespaces
+            if self.sources(name).intersection(changed_files)]
+        if not affected:
+            return False
+        log.info("Re-resolving namespaces", extra=dict(namespaces=affected))
+        env = self.env
+        for name in affected:
+            self.values[name] = self.resolve(name)
+        return env != self.env
+
+
+def _stop(child, grace=10):
+    child.terminate()
+    deadline = time.time() + grace
+    while child.poll() is None and time.time() < deadline:
+        time.sleep(.1)
+    if child.poll() is None:
+        log.warning("App did not exit after SIGTERM.  Killing it",
+                    extra=dict(pid=child.pid))
+        child.kill()
+        child.wait()
+
+
+def watch_app(cmd, watcher, poll, debounce=5, sig=None, wait=300):
+    """Run shell command `cmd` with the environment of an AppWatcher, and
+    restart it whenever that environment changes.  Return the command's exit
+    code once it exits on its own.
+
+    `poll(wait)` block up to `wait` seconds for consul data to change and
+        return the set of files that changed
+    `debounce` seconds to wait for changes to settle before applying them,
+        so that a push of many keys causes only one restart
+    `sig` if given, send this signal to the app instead of restarting it
+    """
+    changes = queue.Queue()
+    stop = threading.Event()
+    t = threading.Thread(
+        target=_poll_forever, args=(poll, wait, changes, stop))
+    t.daemon = True
+    t.start()
+
+    def start():
+        log.info("Starting app", extra=dict(cmd=cmd))
+        return subprocess.Popen(cmd, shell=True, env=watcher.env)
+    app = [start()]  # the running app, replaced on every restart
+
+    def forward(signum, frame):
+        app[0].send_signal(signum)
+    handlers = {signum: signal.signal(signum, forward)
+                for signum in (signal.SIGTERM, signal.SIGINT)}
+    try:
+        return _supervise(app, start, watcher, changes, debounce, sig)
+    finally:
+        stop.set()
+        for signum, handler in handlers.items():
+            signal.signal(signum, handler)
+
+
+def _supervise(app, start, watcher, changes, debounce, sig):
+    pending = set()
+    last_change = 0
+    while True:
+        rc = app[0].poll()
+        if rc is not None:
+            return rc
+        try:
+            pending.update(changes.get(timeout=.25))
+            last_change = time.time()
+            continue
+        except queue.Empty:
+            pass
+        if not pending or time.time() - last_change < debounce:
+            continue
+        changed_files, pending = pending, set()
+        try:
+            if not watcher.refresh(changed_files):
+                continue
+        except Exception:
+            log.exception("Could not resolve the changed namespaces."
+                          "  Leaving the app running as it is")
+            continue
+        if sig:
+            log.info("Environment changed.  Signaling app",
+                     extra=dict(signal=sig, pid=app[0].pid))
+            os.kill(app[0].pid, sig)
+        else:
+            log.info("Environment changed.  Restarting app",
+                     extra=dict(pid=app[0].pid))
+            _stop(app[0])
+            app[0] = start()
@@ -1,9 +1,27 @@
+import glob
+import json
+import logging
 import nose
 import nose.tools as nt
-from os.path import abspath, dirname
+import os
+import re
+from os.path import abspath, dirname, join
+import shutil
+import sys
+import tempfile
+import threading
+import time
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
 import consulconf.main as cc
-import requests
-from consulconf import configure_logging
+from consulconf.main import build_arg_parser
+from consulconf import (
+    artifact, buildcache, cache, configure_logging, deleteplan, output, serve,
+    stats, transport, util, watch, log, KeyValueFormatter,
+    JsonLinesFormatter)
+from consulconf.testing import FakeConsul
 
 CWD = dirname(abspath(__file__))
 
@@ -17,6 +35,13 @@ JSON = {
         "_inherit": ["test._shared2", "test-namespace._shared2"]},
         "key1": "val", },
     'inherit4': {"app1": {"_inherit": ["key_does_not_exist"]}},
+    'cycle': {"app1": {"_inherit": ["app2"]}, "app2": {"_inherit": ["app1"]}},
+    'inherit5': {"app1": {"_inherit": ["chain.mid", "test-ns1"]}},
+
+    # good json
+    'chain': {"_base": {"key1": "val1"},
+              "mid": {"_inherit": ["_base"], "key2": "val2"},
+              "app1": {"_inherit": ["mid"]}},
 }
 
 GLOBAL_TEST_INFO = {}
@@ -25,22 +50,23 @@ GLOBAL_TEST_INFO = {}
 def setup_module():
     configure_logging(True)
 
-    def mock_requests_delete(*args, **kwargs):
-        r = requests.Response()
-        r.status_code = 200
-        return r
-    GLOBAL_TEST_INFO['_requests_delete'] = requests.delete
-    requests.delete = mock_requests_delete
-
     GLOBAL_TEST_INFO['_load_json'] = cc.load_json
 
     def mock_load_json(jsonfn, basedir):
         return JSON.get(jsonfn) or GLOBAL_TEST_INFO['_load_json'](jsonfn, CWD)
-    cc.load_json = mock_load_json
+    cc.load_json = GLOBAL_TEST_INFO['mock_load_json'] = mock_load_json
+    fake_consul()
+
+
+def fake_consul(data=None):
+    """Send all consul requests to a fresh in-memory consul"""
+    consul = FakeConsul(data)
+    transport.configure(adapter=consul)
+    return consul
 
 
 def teardown_module():
-    requests.delete = GLOBAL_TEST_INFO['_requests_delete']
+    transport.reset()
     cc.load_json = GLOBAL_TEST_INFO['_load_json']
 
 
@@ -114,3 +140,837 @@ def test_delete_directories():
         cc.delete_directories(
             keys, delete_excludes=delete_excludes, puturl=puturl),
         set(['c', 'd']))
+
+
+def test_delete_directories_excludes_at_any_depth():
+    data = {'a/test/app1/k': '1', 'a/test/app10/k': '1', 'a/test/app2/k': '1',
+            'a/test/app2/sub/k': '1', 'a/test/k': '1', 'a/other/x/y': '1',
+            'a/othe': '1', 'a/test2/k': '1'}
+    nt.assert_equal(
+        deleteplan.targets(['test/app1', 'test', 'other/x', 'other/x/y']),
+        ['other', 'test'])
+    for txn in (False, True):
+        consul = fake_consul(data)
+        stdout, sys.stdout = sys.stdout, StringIO()
+        try:
+            deleted = cc.delete_directories(
+                ['test/app1', 'test/app2', 'other/x'], ['test/app1'],
+                'http://nourl/v1/kv/a', txn=txn, show_plan=True)
+            plan = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+        nt.assert_set_equal(deleted, set(['test/app2', 'test/k', 'other']))
+        nt.assert_equal(sorted(consul.kv), [
+            'a/othe', 'a/test/app1/k', 'a/test/app10/k', 'a/test2/k'])
+        nt.assert_true(plan.startswith(
+            'delete http://nourl/v1/kv/a: 2 directories, 2 keys,'
+            ' 2 excluded keys kept'))
+
+
+def test_put_to_consul_txn():
+    kvs = {'ns%s' % i: {'key%s' % j: 'val' for j in range(10)}
+           for i in range(10)}
+    kvs['empty'] = {}
+    consul = fake_consul()
+    cc.put_to_consul(kvs, 'http://nourl/v1/kv/a', txn=True)
+
+    nt.assert_equal(consul.requests, [
+        ('PUT', 'http://nourl/v1/txn'), ('PUT', 'http://nourl/v1/txn')])
+    nt.assert_equal(len(consul.kv), 101)
+    nt.assert_equal(consul.get('a/ns0/key0'), 'val')
+    nt.assert_equal(consul.get('a/empty/'), None)
+
+
+def test_run_txn_reports_failed_batch():
+    consul = fake_consul()
+    consul.fail = lambda request: 409 if 'a/k70' in request.body else None
+
+    ops = (('set', 'k%s' % i, 'v') for i in range(100))
+    with nt.assert_raises_regexp(cc.APIFail, 'batch 2 '):
+        cc.run_txn(ops, 'http://nourl/v1/kv/a')
+    nt.assert_equal(len(consul.kv), cc.TXN_MAX_OPS)
+
+
+def test_plan_sync():
+    kvs = {'ns1': {'a': '1', 'b': '2'}, 'ns2': {}, 'ns3': {'c': '3'}}
+    existing = {
+        'ns1/a': '1', 'ns1/b': 'old', 'ns1/gone': 'x', 'ns2/': '',
+        'old/key': 'x', 'keep/key': 'x'}
+    plan = cc.plan_sync(kvs, existing, delete_excludes=['keep'])
+    nt.assert_equal(plan.puts, [('ns1/b', '2'), ('ns3/c', '3')])
+    # old/key is not in a directory this input pushes to
+    nt.assert_equal(plan.deletes, ['ns1/gone'])
+    nt.assert_equal(plan.unchanged, 2)
+
+    plan = cc.plan_sync(kvs, existing, delete_within=['ns1'])
+    nt.assert_equal(plan.deletes, ['ns1/gone'])
+
+
+def test_sync_filterns_only_deletes_selected_namespaces():
+    consul = fake_consul()
+    run_main('-i', CWD, '-p', 'nourl/v1/kv/conf')
+    consul.set('conf/test/stale', 'x')
+    consul.set('conf/test/app1/stale', 'x')
+    consul.set('conf/other-team/key', 'x')
+    out = run_main('-i', CWD, '-p', 'nourl/v1/kv/conf', '--sync',
+                   '--filterns', '^test$', '--dry_run')
+    nt.assert_true(out.startswith(
+        'sync http://nourl/v1/kv/conf: 0 to put, 1 to delete'), out)
+    nt.assert_true(out.endswith('  delete  test/stale\n'), out)
+
+    out = run_main('-i', CWD, '-p', 'nourl/v1/kv/conf', '--sync',
+                   '--dry_run')
+    nt.assert_false('other-team' in out)
+    nt.assert_true('test/app1/stale' in out)
+
+
+def test_sync_to_consul():
+    consul = fake_consul({'a/ns1/a': '1', 'a/ns1/gone': ''})
+    kvs = {'ns1': {'a': '1', 'b': '2'}}
+
+    cc.sync_to_consul(kvs, 'http://nourl/v1/kv/a', dry_run=True)
+    nt.assert_equal([x[0] for x in consul.requests], ['GET'])
+
+    del consul.requests[:]
+    cc.sync_to_consul(kvs, 'http://nourl/v1/kv/a')
+    nt.assert_equal(consul.requests, [
+        ('GET', 'http://nourl/v1/kv/a/?recurse=True'),
+        ('PUT', 'http://nourl/v1/kv/a/ns1/b'),
+        ('DELETE', 'http://nourl/v1/kv/a/ns1/gone')])
+    nt.assert_equal(sorted(consul.kv), ['a/ns1/a', 'a/ns1/b'])
+
+
+def test_push_to_several_targets():
+    consul = fake_consul()
+    sessions = []
+    new_session = transport.new_session
+
+    def _new_session():
+        sessions.append(new_session())
+        return sessions[-1]
+    transport.new_session = _new_session
+    try:
+        run_main('-i', CWD, '--txn', '-p', 'dc1/v1/kv/a', 'dc2/v1/kv/b')
+        nt.assert_equal(len(sessions), 2)
+        nt.assert_equal(
+            sorted(k[2:] for k in consul.kv if k.startswith('a/')),
+            sorted(k[2:] for k in consul.kv if k.startswith('b/')))
+        nt.assert_true(consul.kv)
+
+        consul = fake_consul()
+        consul.fail = lambda request: 500 if 'dc2' in request.url else None
+        with nt.assert_raises_regexp(
+                cc.APIFail, '^1 of 2 targets failed.  http://dc2/v1/kv/b:'):
+            run_main('-i', CWD, '--txn', '-p', 'dc1/v1/kv/a', 'dc2/v1/kv/b')
+        nt.assert_true(any(k.startswith('a/') for k in consul.kv))
+        nt.assert_false(any(k.startswith('b/') for k in consul.kv))
+    finally:
+        transport.new_session = new_session
+
+
+def test_load_json_from_consul():
+    consul = fake_consul({
+        'conf/test/app1/key1': 'val1', 'conf/test/app2/_inherit': '["a.b"]',
+        'conf/test/app3/': None, 'conf/other/key': 'x'})
+    load_json = GLOBAL_TEST_INFO['_load_json']
+    nt.assert_dict_equal(
+        load_json('test', 'http://nourl/v1/kv/conf/'), {
+            'app1': {'key1': 'val1'}, 'app2': {'_inherit': ['a.b']},
+            'app3': {}})
+    nt.assert_equal(consul.requests, [
+        ('GET', 'http://nourl/v1/kv/conf/test/?recurse=True')])
+    cc.clear_cache()
+
+
+def test_stale_reads_fall_back_to_leader():
+    consul = fake_consul({'conf/test/app1/key1': 'val1'})
+    load_json = GLOBAL_TEST_INFO['_load_json']
+    url = 'http://nourl/v1/kv/conf/test/'
+    transport.configure(consistency='stale', max_stale=1)
+    try:
+        load_json('test', 'http://nourl/v1/kv/conf/')
+        nt.assert_equal(consul.requests, [
+            ('GET', '%s?recurse=True&stale=True' % url)])
+
+        cc.clear_cache()
+        del consul.requests[:]
+        consul.last_contact = 1500
+        nt.assert_dict_equal(
+            load_json('test', 'http://nourl/v1/kv/conf/'),
+            {'app1': {'key1': 'val1'}})
+        nt.assert_equal(consul.requests, [
+            ('GET', '%s?recurse=True&stale=True' % url),
+            ('GET', '%s?recurse=True' % url)])
+
+        # reads of the push target are not stale
+        del consul.requests[:]
+        cc.fetch_existing('http://nourl/v1/kv/conf')
+        nt.assert_equal(consul.requests, [
+            ('GET', 'http://nourl/v1/kv/conf/?recurse=True')])
+
+        transport.configure(consistency='consistent')
+        cc.clear_cache()
+        del consul.requests[:]
+        load_json('test', 'http://nourl/v1/kv/conf/')
+        nt.assert_equal(consul.requests, [
+            ('GET', '%s?recurse=True&consistent=True' % url)])
+        with nt.assert_raises(ValueError):
+            transport.configure(consistency='eventual')
+    finally:
+        transport.configure(consistency='default', max_stale=None)
+        cc.clear_cache()
+
+
+def test_tree_cache():
+    tc = cache.TreeCache(maxsize=2)
+    tc.put('a', 'base', {'a': '1'}, index=5)
+    tc.put('b', 'base', {'b': '1'}, index=9)
+    nt.assert_dict_equal(tc.get('a', 'base'), {'a': '1'})
+    generation = tc.generation
+    tc.put('c', 'base', {'c': '1'})
+    with nt.assert_raises(KeyError):
+        tc.get('b', 'base')  # least recently used
+    tc.put('b', 'base', {'b': '1'}, index=9)  # reloaded unchanged
+    nt.assert_equal(tc.generation, generation)
+    tc.put('b', 'base', {'b': '2'}, index=10)
+    nt.assert_true(tc.generation > generation)
+    with tc.pinned():
+        tc.put('x', 'base', {})
+        tc.put('y', 'base', {})
+        nt.assert_equal(tc.stats()['size'], 4)
+    nt.assert_equal(tc.stats()['size'], 2)
+    nt.assert_equal(tc.invalidate(basepath='base', older_than=6), 2)
+    with nt.assert_raises(KeyError):
+        tc.get('a', 'base')
+    tc.put_missing('d', 'base', IOError('nope'))
+    with nt.assert_raises_regexp(IOError, 'nope'):
+        tc.get('d', 'base')
+    tc.configure(maxsize=None, ttl=-1)
+    tc.put('e', 'base', {})
+    with nt.assert_raises(KeyError):
+        tc.get('e', 'base')  # expired
+    stats = tc.stats()
+    nt.assert_equal(
+        (stats['hits'], stats['misses'], stats['negative_hits'],
+         stats['evictions'], stats['expirations'], stats['size']),
+        (1, 3, 1, 4, 1, 1))
+
+
+def test_load_json_caches_missing_files():
+    consul = fake_consul({'conf/test/key': 'val'})
+    load_json = GLOBAL_TEST_INFO['_load_json']
+    try:
+        for _ in range(2):
+            with nt.assert_raises(cc.NotFound):
+                load_json('missing', 'http://nourl/v1/kv/conf/')
+            load_json('test', 'http://nourl/v1/kv/conf/')
+        nt.assert_equal(len(consul.requests), 2)
+        cc.tree_cache.invalidate('test')
+        load_json('test', 'http://nourl/v1/kv/conf/')
+        nt.assert_equal(len(consul.requests), 3)
+        # a run reads each file more than once.  Never evict between reads
+        nt.assert_equal(cc.tree_cache.maxsize, None)
+    finally:
+        cc.clear_cache()
+
+
+def test_bounded_tree_cache():
+    load_json, cc.load_json = cc.load_json, GLOBAL_TEST_INFO['_load_json']
+    try:
+        files = cc.list_files(CWD)
+        expected = cc.parse_all(files, CWD)
+        cc.clear_cache()
+        cc.tree_cache.configure(maxsize=1)
+        nt.assert_dict_equal(cc.parse_all(files, CWD), expected)
+        nt.assert_equal(cc.tree_cache.stats()['size'], 1)
+        # reloading unchanged files keeps the namespaces resolved so far
+        generation = cc.tree_cache.generation
+        nt.assert_dict_equal(cc.parse_all(files, CWD), expected)
+        nt.assert_equal(cc.tree_cache.generation, generation)
+    finally:
+        cc.load_json = load_json
+        cc.tree_cache.configure(maxsize=None)
+        cc.clear_cache()
+
+
+def test_pool_holds_concurrent_requests():
+    try:
+        for args, pool_size in [([], 10), (['--concurrency', '32'], 32),
+                                (['--pool_size', '40'], 40)]:
+            cc._configure_transport(
+                build_arg_parser().parse_args(['-i', CWD] + args))
+            nt.assert_equal(transport._options['pool_size'], pool_size)
+    finally:
+        transport.configure(pool_size=transport.DEFAULTS['pool_size'])
+
+
+def test_put_to_consul_concurrently():
+    kvs = {'ns%s' % i: {'key%s' % j: str(j) for j in range(10)}
+           for i in range(10)}
+    kvs['empty'] = {}
+    serial = fake_consul()
+    cc.put_to_consul(kvs, 'http://nourl/v1/kv/a')
+    concurrent = fake_consul()
+    cc.put_to_consul(kvs, 'http://nourl/v1/kv/a', concurrency=8)
+    nt.assert_dict_equal(
+        {k: serial.get(k) for k in serial.kv},
+        {k: concurrent.get(k) for k in concurrent.kv})
+
+    consul = fake_consul()
+    consul.fail = lambda request: (
+        500 if request.url.endswith(('ns3/key1', 'ns7/key2')) else None)
+    with nt.assert_raises_regexp(cc.APIFail, '^2 PUT requests failed'):
+        cc.put_to_consul(kvs, 'http://nourl/v1/kv/a', concurrency=8)
+    nt.assert_equal(len(consul.kv), 99)
+
+
+def test_run_concurrently():
+    def func(x):
+        if x % 10 == 3:
+            raise ValueError(x)
+    errors = util.run_concurrently(func, iter(range(100)), 4)
+    nt.assert_equal([x for x, _ in errors], list(range(3, 100, 10)))
+
+
+def test_prefetch():
+    consul = fake_consul({
+        'conf/test/app1/key1': 'val1', 'conf/test/app2/_inherit': '["a.b"]',
+        'conf/test/app3/': None, 'conf/other/key': 'x', 'conf/': None})
+    basepath = 'http://nourl/v1/kv/conf'
+    load_json = cc.load_json = GLOBAL_TEST_INFO['_load_json']
+    try:
+        nt.assert_equal(cc.prefetch(basepath), ['other', 'test'])
+        nt.assert_dict_equal(
+            load_json('test', 'http://nourl/v1/kv/conf/'), {
+                'app1': {'key1': 'val1'}, 'app2': {'_inherit': ['a.b']},
+                'app3': {}})
+        nt.assert_dict_equal(
+            load_json('other', 'http://nourl/v1/kv/conf/'), {'key': 'x'})
+        with nt.assert_raises(cc.APIFail):
+            load_json('missing', 'http://nourl/v1/kv/conf/')
+        nt.assert_equal(consul.requests, [
+            ('GET', 'http://nourl/v1/kv/conf/?recurse=True')])
+    finally:
+        cc.clear_cache()
+        cc.load_json = GLOBAL_TEST_INFO['mock_load_json']
+
+
+def run_main(*args):
+    """Run consulconf with the given command-line args and return stdout"""
+    ns = build_arg_parser().parse_args(list(args))
+    stdout = sys.stdout
+    sys.stdout = StringIO()
+    cc.load_json = GLOBAL_TEST_INFO['_load_json']
+    try:
+        cc.main(ns)
+        return sys.stdout.getvalue()
+    finally:
+        sys.stdout = stdout
+        cc.clear_cache()
+        cc.load_json = GLOBAL_TEST_INFO['mock_load_json']
+
+
+def test_output_formats():
+    for raw in ([], ['--raw']):
+        expected = json.loads(run_main('-i', CWD, '--dry_run', *raw))
+        lines = run_main('-i', CWD, '--dry_run', '--output_format', 'ndjson',
+                         '--sort_output', '--sort_buffer', '3', *raw)
+        names = []
+        merged = {}
+        for line in lines.splitlines():
+            item = json.loads(line)
+            names.extend(item)
+            merged.update(item)
+        nt.assert_dict_equal(merged, expected)
+        nt.assert_equal(names, sorted(expected))
+
+    nt.assert_equal(
+        run_main('-i', CWD, '--dry_run', '--output_format', 'env',
+                 '--filterns', '^test/app21$'),
+        "# test/app21\nkey=value\nkey1=val1\n")
+    nt.assert_equal(
+        output.format_env('ns', {'A': "it's"}), "# ns\nA='it'\"'\"'s'\n")
+    nt.assert_equal(
+        output.format_env('ns', {'A': 5, 'B': None}), "# ns\nA=5\nB=None\n")
+    with nt.assert_raises(ValueError):
+        run_main('-i', CWD, '--dry_run', '--raw', '--output_format', 'env')
+
+
+def test_main_consul_input_same_as_files():
+    consul = fake_consul()
+    run_main('-i', CWD, '-p', 'nourl/v1/kv/conf')
+    del consul.requests[:]
+    from_consul = json.loads(run_main(
+        '-i', 'http://nourl/v1/kv/conf', '--dry_run'))
+    nt.assert_equal(consul.requests, [
+        ('GET', 'http://nourl/v1/kv/conf/?recurse=True')])
+    nt.assert_dict_equal(
+        from_consul, json.loads(run_main('-i', CWD, '--dry_run')))
+
+
+def test_namespace_sources_follow_inherit_chains():
+    consul = fake_consul({
+        'conf-chain/app/svc/_inherit': '["mid.svc"]',
+        'conf-chain/mid/svc/_inherit': '["base._shared.key1"]',
+        'conf-chain/base/_shared/key1': 'val1',
+        'conf-chain/other/key': 'x'})
+    basepath = 'http://nourl/v1/kv/conf-chain/'
+    cc.load_json = GLOBAL_TEST_INFO['_load_json']
+    try:
+        nt.assert_dict_equal(
+            cc.resolve_namespace('app/svc', basepath), {'key1': 'val1'})
+        nt.assert_equal(
+            cc.namespace_sources('app/svc', basepath),
+            set(['app', 'mid', 'base']))
+        watcher = watch.AppWatcher(
+            ['app/svc'],
+            resolve=lambda name: cc.resolve_namespace(name, basepath),
+            sources=lambda name: cc.namespace_sources(name, basepath))
+        consul.set('conf-chain/base/_shared/key1', 'val2')
+        cc.clear_cache()
+        nt.assert_true(watcher.refresh(set(['base'])))
+        nt.assert_dict_equal(watcher.env, {'key1': 'val2'})
+    finally:
+        cc.clear_cache()
+        cc.load_json = GLOBAL_TEST_INFO['mock_load_json']
+
+
+def test_watch_app_restarts_on_change():
+    consul = fake_consul({
+        'conf-watch/test/_shared/key1': 'val1',
+        'conf-watch/test/app2/_inherit': '["_shared"]',
+        'conf-watch/test/app3/key3': 'val3',
+        'conf-watch/other/key': 'x'})
+    basepath = 'http://nourl/v1/kv/conf-watch/'
+    outfile = tempfile.NamedTemporaryFile()
+    cc.load_json = GLOBAL_TEST_INFO['_load_json']
+    try:
+        cc.prefetch(basepath)
+        watcher = watch.AppWatcher(
+            ['test/app2'],
+            resolve=lambda name: cc.resolve_namespace(name, basepath),
+            sources=lambda name: cc.namespace_sources(name, basepath))
+        nt.assert_dict_equal(watcher.env, {'key1': 'val1'})
+
+        def change():
+            time.sleep(.5)
+            # does not affect test/app2
+            consul.set('conf-watch/other/key', 'y')
+            time.sleep(.5)
+            consul.set('conf-watch/test/_shared/key1', 'val2')
+        threading.Thread(target=change).start()
+        rc = watch.watch_app(
+            'echo $key1 >> %s; [ $key1 = val2 ] || sleep 10' % outfile.name,
+            watcher, poll=lambda wait: cc.poll_changes(basepath, wait),
+            debounce=0, wait=5)
+    finally:
+        cc.clear_cache()
+        cc.load_json = GLOBAL_TEST_INFO['mock_load_json']
+    nt.assert_equal(rc, 0)
+    nt.assert_equal(open(outfile.name).read().split(), ['val1', 'val2'])
+
+
+def test_watch_app_resolves_from_the_watched_snapshot():
+    consul = fake_consul({'conf-watch/test/app3/key3': 'val3'})
+    ns = build_arg_parser().parse_args(
+        ['-i', 'http://nourl/v1/kv/conf-watch', '--watch',
+         '--app', 'test/app3', 'true'])
+    watchers = []
+    watch_app, watch.watch_app = watch.watch_app, (
+        lambda cmd, watcher, **kwargs: watchers.append(watcher))
+    cc.load_json = GLOBAL_TEST_INFO['_load_json']
+    try:
+        cc._watch_app(ns, ['test/app3'], {}, 'http://nourl/v1/kv/conf-watch/')
+    finally:
+        watch.watch_app = watch_app
+        cc.clear_cache()
+        cc.load_json = GLOBAL_TEST_INFO['mock_load_json']
+    nt.assert_dict_equal(watchers[0].env, {'key3': 'val3'})
+    # the index that poll_changes blocks on is from this same request
+    nt.assert_equal(consul.requests, [
+        ('GET', 'http://nourl/v1/kv/conf-watch/?recurse=True')])
+
+
+def test_app_snapshot_cache():
+    consul = fake_consul({
+        'conf/test/_shared/key1': 'val1',
+        'conf/test/app2/_inherit': '["_shared"]',
+        'conf/other/key': 'x'})
+    cache_dir = tempfile.mkdtemp()
+    args = ('-i', 'http://nourl/v1/kv/conf', '--cache_dir', cache_dir,
+            '--app', 'test/app2', 'echo', '$key1')
+
+    def run():
+        del consul.requests[:]
+        cc.load_json = GLOBAL_TEST_INFO['_load_json']
+        try:
+            return cc._cached_apps(build_arg_parser().parse_args(args),
+                                   'http://nourl/v1/kv/conf/')
+        finally:
+            cc.clear_cache()
+            cc.load_json = GLOBAL_TEST_INFO['mock_load_json']
+
+    try:
+        nt.assert_dict_equal(run(), {'test/app2': {'key1': 'val1'}})
+        nt.assert_equal(len(consul.requests), 2)
+        nt.assert_dict_equal(run(), {'test/app2': {'key1': 'val1'}})
+        nt.assert_equal(len(consul.requests), 1)  # only the index check
+
+        consul.set('conf/test/_shared/key1', 'val2')
+        nt.assert_dict_equal(run(), {'test/app2': {'key1': 'val2'}})
+
+        consul.fail = lambda request: 500
+        nt.assert_dict_equal(run(), {'test/app2': {'key1': 'val2'}})
+        args = ('--cache_max_stale', '0') + args
+        time.sleep(.01)
+        with nt.assert_raises(cc.APIFail):
+            run()
+    finally:
+        shutil.rmtree(cache_dir)
+
+
+def test_app_exec():
+    calls = []
+    execvpe, os.execvpe = os.execvpe, lambda *args: calls.append(args)
+    try:
+        run_main('-i', CWD, '--exec', '--daemon', '',
+                 '--app', 'test/app20', 'echo', '$key', 'a b')
+    finally:
+        os.execvpe = execvpe
+    nt.assert_equal(
+        calls, [('echo', ['echo', '$key', 'a b'], {'key': 'value'})])
+    with nt.assert_raises(ValueError):
+        run_main('-i', CWD, '--exec', '--app', 'test/app20')
+
+
+def test_compile_artifacts():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        paths = cc.compile_apps(
+            ['test/app21', 'test-ns1+test/app20'], CWD, tmpdir)
+        nt.assert_equal(len(paths), 6)
+        fp = artifact.artifact_path(tmpdir, 'test-ns1+test/app20')
+        nt.assert_dict_equal(
+            artifact.load(fp), {'key': 'value', 'key1': 'val1'})
+        with artifact.Artifact(fp) as art:
+            nt.assert_equal(art['key1'], 'val1')
+            nt.assert_equal(art.get('key2'), None)
+        with open(join(tmpdir, 'test%2Fapp21.env')) as fin:
+            nt.assert_equal(fin.read(), '# test/app21\nkey=value\nkey1=val1\n')
+        with open(join(tmpdir, 'test%2Fapp21.envdir', 'key1')) as fin:
+            nt.assert_equal(fin.read(), 'val1')
+        # recompiling swaps the envdir symlink to a new version
+        envdir = join(tmpdir, 'test%2Fapp21.envdir')
+        nt.assert_true(os.path.islink(envdir))
+        cc.compile_apps(['test/app21'], CWD, tmpdir, formats=['envdir'])
+        nt.assert_equal(sorted(os.listdir(envdir)), ['key', 'key1'])
+        nt.assert_equal(
+            len([x for x in os.listdir(tmpdir)
+                 if x.startswith('test%2Fapp21.envdir.')]), 1)
+        big = {'K%s' % i: 'v%s' % i for i in range(100)}
+        artifact.write(join(tmpdir, 'big.kv'), big)
+        with artifact.Artifact(join(tmpdir, 'big.kv')) as art:
+            nt.assert_equal(len(art), 100)
+            nt.assert_true(all(art[k] == v for k, v in big.items()))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_write_envdir_keeps_old_envdir_on_failure():
+    tmpdir = tempfile.mkdtemp()
+    envdir = join(tmpdir, 'app.envdir')
+    rename = os.rename
+
+    def failing_rename(src, dst):
+        if dst == envdir and os.path.islink(src):
+            raise OSError('rename failed')
+        return rename(src, dst)
+
+    def check():
+        os.rename = failing_rename
+        try:
+            with nt.assert_raises(OSError):
+                cc._write_envdir(envdir, {'key': 'new'})
+        finally:
+            os.rename = rename
+        with open(join(envdir, 'key')) as fin:
+            nt.assert_equal(fin.read(), 'old')
+        return sorted(os.listdir(tmpdir))
+
+    try:
+        # a plain envdir, written by older versions, is moved back
+        os.mkdir(envdir)
+        with open(join(envdir, 'key'), 'w') as fout:
+            fout.write('old')
+        nt.assert_equal(check(), ['app.envdir'])
+        shutil.rmtree(envdir)
+        cc._write_envdir(envdir, {'key': 'old'})
+        nt.assert_equal(len(check()), 2)  # the symlink and its version
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_app_loads_only_needed_files():
+    consul = fake_consul()
+    run_main('-i', CWD, '-p', 'nourl/v1/kv/conf', '--raw')
+    del consul.requests[:]
+    run_main('-i', 'http://nourl/v1/kv/conf', '--daemon', '',
+             '--app', 'test/app22', 'true')
+    nt.assert_equal(sorted(consul.requests), [
+        ('GET', 'http://nourl/v1/kv/conf/test-ns1/?recurse=True'),
+        ('GET', 'http://nourl/v1/kv/conf/test/?recurse=True')])
+
+    nt.assert_dict_equal(
+        cc.resolve_namespaces(['test/app22', 'test-ns2'], CWD),
+        {'test/app22': {'key1': 'val1'}, 'test-ns2': {'key1': 'val1'}})
+
+    # streaming raw output reads file by file, rather than the whole tree
+    del consul.requests[:]
+    run_main('-i', 'http://nourl/v1/kv/conf', '--raw', '--dry_run',
+             '--output_format', 'ndjson')
+    nt.assert_false(
+        ('GET', 'http://nourl/v1/kv/conf/?recurse=True') in consul.requests)
+
+
+def test_raw_copy_streams_files():
+    nt.assert_equal(
+        list(cc.iter_raw({'a': {'b': {}, 'c': [1]}, 'd': 1}, 'f')),
+        [('f/a/c', '[1]'), ('f/d', 1)])
+    consul = fake_consul({'copy/test-ns1/old': 'x', 'copy/keep/k': 'x'})
+    run_main('-i', CWD, '-p', 'nourl/v1/kv/conf', '--raw')
+    source = sorted(
+        (k[len('conf/'):], v[0]) for k, v in consul.kv.items()
+        if k.startswith('conf/'))
+    del consul.requests[:]
+    run_main('-i', 'http://nourl/v1/kv/conf', '-p', 'nourl/v1/kv/copy',
+             '--raw', '--delete', '--txn')
+    nt.assert_equal(source, sorted(
+        (k[len('copy/'):], v[0]) for k, v in consul.kv.items()
+        if k.startswith('copy/') and k != 'copy/keep/k'))
+    nt.assert_true('copy/keep/k' in consul.kv)
+    nt.assert_equal(
+        consul.requests[0],
+        ('GET', 'http://nourl/v1/kv/conf/?keys=True&separator=%2F'))
+    nt.assert_false(
+        ('GET', 'http://nourl/v1/kv/conf/?recurse=True') in consul.requests)
+    # each file is deleted and written before the next one is read
+    nt.assert_true(
+        consul.requests.index(('PUT', 'http://nourl/v1/txn'))
+        < consul.requests.index(
+            ('GET', 'http://nourl/v1/kv/conf/test-ns2/?recurse=True')))
+
+
+def test_stats():
+    consul = fake_consul()
+    tmpdir = tempfile.mkdtemp()
+    try:
+        fp = join(tmpdir, 'stats.json')
+        run_main('-i', CWD, '-p', 'nourl/v1/kv/conf', '--txn', '--stats', fp)
+        with open(fp) as fin:
+            report = json.load(fin)
+    finally:
+        shutil.rmtree(tmpdir)
+    nt.assert_true(
+        set(['list', 'fetch', 'parse', 'resolve', 'push']).issubset(
+            report['phases']))
+    nt.assert_true(
+        sum(report['phases'].values()) <= report['wall_seconds'])
+    nt.assert_equal(report['http']['requests'], len(consul.requests))
+    nt.assert_equal(report['http']['methods'], {'PUT': len(consul.requests)})
+    nt.assert_true(report['http']['bytes_sent'] > 0)
+    nt.assert_true(report['cache']['misses'] > 0)
+
+    with stats.collect() as collector:
+        with stats.phase('outer'):
+            with stats.phase('inner'):
+                time.sleep(0.05)
+    phases = collector.report()['phases']
+    nt.assert_true(phases['inner'] >= 0.05 > phases['outer'])
+    nt.assert_equal(stats.percentile([1, 2, 3, 4], 50), 3)
+
+
+def test_log_formatters():
+    record = logging.makeLogRecord(dict(
+        msg='hello %s', args=('you', ), a=1, levelname='INFO', created=1))
+    nt.assert_equal(KeyValueFormatter().format(record), 'hello you    a=1')
+    nt.assert_equal(record.msg, 'hello %s')
+    nt.assert_dict_equal(
+        json.loads(JsonLinesFormatter().format(record)),
+        {'msg': 'hello you', 'a': 1, 'level': 'INFO', 'time': 1})
+
+    handlers, log.handlers = log.handlers, []
+    try:
+        configure_logging(False)
+        nt.assert_false(log.isEnabledFor(logging.CRITICAL))
+    finally:
+        log.handlers = handlers
+        configure_logging(True)
+    nt.assert_true(log.isEnabledFor(logging.DEBUG))
+
+
+def test_filterns_skips_files():
+    nt.assert_equal(cc.regex_prefix('^test/app2[0-9]$'), 'test/app2')
+    nt.assert_equal(cc.regex_prefix('^tests?/'), 'test')
+    nt.assert_equal(cc.regex_prefix('^a|^b'), None)
+    nt.assert_equal(cc.regex_prefix('app'), None)
+
+    everything = json.loads(run_main('-i', CWD, '--dry_run'))
+    for regex in ['^test/app2', '^test-ns', 'app2', '^test$']:
+        nt.assert_dict_equal(
+            json.loads(run_main('-i', CWD, '--dry_run', '--filterns', regex)),
+            {k: v for k, v in everything.items() if re.search(regex, k)})
+
+    consul = fake_consul()
+    run_main('-i', CWD, '-p', 'nourl/v1/kv/conf', '--raw')
+    del consul.requests[:]
+    nt.assert_dict_equal(
+        json.loads(run_main('-i', 'http://nourl/v1/kv/conf', '--dry_run',
+                            '--filterns', '^test/app22$')),
+        {'test/app22': {'key1': 'val1'}})
+    nt.assert_equal(sorted(consul.requests), [
+        ('GET', 'http://nourl/v1/kv/conf/?keys=True&separator=%2F'),
+        ('GET', 'http://nourl/v1/kv/conf/test-ns1/?recurse=True'),
+        ('GET', 'http://nourl/v1/kv/conf/test/?recurse=True')])
+
+
+def test_serve():
+    consul = fake_consul()
+    tmpdir = tempfile.mkdtemp()
+    address = join(tmpdir, 'consulconf.sock')
+    basepath = 'http://nourl/v1/kv/conf/'
+    loads = []
+
+    def load():
+        loads.append(1)
+        return {'ns1': {'a': str(len(loads))}, 'test/app1': {'b': '2'}}
+    daemon = serve.Daemon(basepath, load)
+    server = serve.make_server(daemon, address)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    try:
+        nt.assert_dict_equal(
+            serve.lookup(address, basepath, ['ns1', 'test/app1']),
+            {'ns1': {'a': '1'}, 'test/app1': {'b': '2'}})
+        nt.assert_is_none(serve.lookup(address, basepath, ['ns1', 'nope']))
+        nt.assert_is_none(serve.lookup(address, 'otherpath', ['ns1']))
+        daemon.refresh()
+        nt.assert_dict_equal(
+            serve.lookup(address, basepath, ['ns1']), {'ns1': {'a': '2'}})
+        run_main('-i', basepath, '--daemon', address, '--app', 'ns1', 'true')
+        nt.assert_equal(consul.requests, [])
+
+        # refreshing has failed for too long:  clients resolve by themselves
+        daemon.max_age = 60
+        daemon.checked -= 120
+        nt.assert_is_none(serve.lookup(address, basepath, ['ns1']))
+        nt.assert_true(daemon.status()['stale'])
+        # an unchanged input that was checked fine is not stale
+        stop = threading.Event()
+        daemon.poll = lambda wait: stop.set() or set()
+        daemon.refresh_forever(stop)
+        nt.assert_dict_equal(
+            serve.lookup(address, basepath, ['ns1']), {'ns1': {'a': '2'}})
+    finally:
+        server.shutdown()
+        server.server_close()
+        shutil.rmtree(tmpdir)
+    nt.assert_is_none(serve.lookup(address, basepath, ['ns1']))
+
+
+def test_inherit_transitive():
+    data = dict(cc.parse('chain', CWD))
+    nt.assert_dict_equal(data['chain/app1'], {'key1': 'val1', 'key2': 'val2'})
+    # key1 is inherited from chain._base via chain.mid, and from test-ns1
+    with nt.assert_raises(cc.DuplicateKeyError):
+        dict(cc.parse('inherit5', CWD))
+
+
+def test_inherit_graph():
+    graph = cc.inherit_graph(['chain', 'test'], CWD)
+    nt.assert_equal(graph[('chain', ('app1', ))], [('chain', ('mid', ))])
+    nt.assert_equal(graph[('test', ('app9', ))], [
+        ('test-namespace', ('_shared3', 'key2')),
+        ('test', ('_shared', 'key1'))])
+    order = cc.inherit_order(graph)
+    nt.assert_true(
+        order.index(('chain', ('mid', ))) < order.index(('chain', ('app1', ))))
+
+    with nt.assert_raises_regexp(cc.InheritanceCycleError,
+                                 'cycle.app1 -> cycle.app2 -> cycle.app1'):
+        cc.inherit_order(cc.inherit_graph(['cycle'], CWD))
+    with nt.assert_raises(cc.InheritanceCycleError):
+        dict(cc.parse('cycle', CWD))
+    with nt.assert_raises(KeyError):
+        cc.resolve_inheritance(['test', 'inherit4'], CWD)
+
+
+def test_build_cache():
+    basepath = tempfile.mkdtemp()
+    for fn in glob.glob(join(CWD, 'test*.json')):
+        shutil.copy(fn, basepath)
+    files = sorted(x[:-5] for x in os.listdir(basepath))
+    cache_fp = join(basepath, 'cache', 'build.json')
+    real_load_json = GLOBAL_TEST_INFO['_load_json']
+
+    def build():
+        cc.load_json = real_load_json
+        try:
+            return buildcache.build(
+                files, basepath, cache_fp,
+                parse=lambda jsonfn: cc.parse(jsonfn, basepath),
+                dependencies=lambda f: cc.file_dependencies(f, basepath),
+                validate=lambda fs: cc.resolve_inheritance(fs, basepath))
+        finally:
+            cc.clear_cache()
+            cc.load_json = GLOBAL_TEST_INFO['mock_load_json']
+
+    try:
+        kvs, rebuilt = build()
+        nt.assert_equal(rebuilt, files)
+        nt.assert_dict_equal(
+            kvs, json.loads(run_main('-i', CWD, '--dry_run')))
+        nt.assert_equal(build(), (kvs, []))
+
+        with open(join(basepath, 'test-ns1.json'), 'w') as fout:
+            json.dump({'key1': 'changed'}, fout)
+        kvs, rebuilt = build()
+        # test.app22 and test-ns2 inherit from test-ns1
+        nt.assert_equal(rebuilt, ['test', 'test-ns1', 'test-ns2'])
+        nt.assert_dict_equal(kvs['test/app22'], {'key1': 'changed'})
+        nt.assert_dict_equal(kvs['test-ns2'], {'key1': 'changed'})
+    finally:
+        shutil.rmtree(basepath)
+
+
+def test_parse_parallel():
+    nt.assert_dict_equal(
+        json.loads(run_main('-i', CWD, '--dry_run', '--jobs', '3')),
+        json.loads(run_main('-i', CWD, '--dry_run')))
+    nt.assert_dict_equal(
+        json.loads(run_main('-i', CWD, '--dry_run', '--raw', '--jobs', '3')),
+        json.loads(run_main('-i', CWD, '--dry_run', '--raw')))
+
+    basepath = tempfile.mkdtemp()
+    try:
+        for fn in glob.glob(join(CWD, 'test*.json')):
+            shutil.copy(fn, basepath)
+        with open(join(basepath, 'bad.json'), 'w') as fout:
+            json.dump(JSON['inherit4'], fout)
+        for jobs in ('1', '3'):
+            with nt.assert_raises(KeyError):
+                run_main('-i', basepath, '--dry_run', '--jobs', jobs)
+    finally:
+        shutil.rmtree(basepath)
+
+
+def test_build_json():
+    items = [('conf/test/app1/', ''), ('conf/test/app1/key1', 'val1'),
+             ('conf/test/app2/_inherit', '["_shared"]'),
+             ('conf/test/app3/_inherit', ''), ('conf/test/app4/', ''),
+             ('conf/test/', ''), ('conf/test/app5/key1', 'val1'),
+             ('conf/test/app5/', '')]
+    nt.assert_dict_equal(
+        cc._build_json(cc._relative_keys('conf/test', items)), {
+            'app1': {'key1': 'val1'}, 'app2': {'_inherit': ['_shared']},
+            'app3': {'_inherit': []}, 'app4': {}, 'app5': {'key1': 'val1'}})